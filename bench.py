@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for per-call client overhead (no network involved).
+
+Run with ``python bench.py``.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import base64
+import timeit
+from urllib import urlencode
+from urllib2 import build_opener, HTTPSHandler, HTTPDefaultErrorHandler, HTTPErrorProcessor
+
+from pmill.api import BASE_URL, Paymill
+
+PARAMS = {
+    'amount': 3000, 'currency': 'EUR', 'client': None, 'description': '',
+    'event_types': ['transaction.created', None, 'refund.succeeded'],
+}
+
+
+class LegacyPaymill(Paymill):
+    """Request construction as done before the precomputed request template"""
+    def _urlencode(self, params, doseq=True):
+        _tmp = []
+        if isinstance(params, dict):
+            params = params.iteritems()
+
+        for k, v in params:
+            if isinstance(v, (list, tuple)):
+                v = [x for x in v if x not in self.EMPTY]
+                if not k.endswith('[]'):
+                    k = '{0}[]'.format(k)
+
+            if v not in self.EMPTY:
+                _tmp.append((k, v))
+
+        return urlencode(_tmp, doseq)
+
+    def _prepare_call(self, endpoint, params, method, headers):
+        opener = build_opener(HTTPSHandler, HTTPDefaultErrorHandler, HTTPErrorProcessor)
+
+        auth = base64.standard_b64encode('{0}:'.format(self.private_key))
+        _headers = {
+            'Authorization': 'Basic {0}'.format(auth)
+        }
+        _headers.update(headers or {})
+        opener.addheaders = _headers.items()
+
+        url = '{0}{1}'.format(BASE_URL, endpoint)
+        data = None
+        if params:
+            params = self._urlencode(params)
+            if method in ('POST', 'PUT'):
+                data = params
+            else:
+                url = '{0}?{1}'.format(url, params)
+
+        return (opener, url, data)
+
+
+def bench(name, func, number=20000):
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    print('{0:<40} {1:8.2f} us/call'.format(name, best / number * 1e6))
+    return best
+
+
+def main():
+    for label, api in (('legacy', LegacyPaymill('fake-key')), ('current', Paymill('fake-key'))):
+        bench('{0} _urlencode'.format(label), lambda: api._urlencode(PARAMS))
+        bench('{0} _prepare_call GET'.format(label),
+            lambda: api._prepare_call('transactions/', {'count': 100, 'offset': 0}, 'GET', None))
+        bench('{0} _prepare_call POST'.format(label),
+            lambda: api._prepare_call('transactions/', PARAMS, 'POST', None))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 from __future__ import (print_function, division, absolute_import, unicode_literals)
 
 from .api import Paymill, PaymillError
+from .pool import PaymillPool
 from .version import __version__
 
-__all__ = ('Paymill', 'PaymillError')
+__all__ = ('Paymill', 'PaymillError', 'PaymillPool')
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from .cli import main
+
+main()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from collections import namedtuple
+from datetime import date, datetime
+import json
+import sqlite3
+import threading
+import time
+
+from .api import PaymillList, PaymillObject, Refund, Transaction
+
+__all__ = ('SettlementAggregates', 'Totals')
+
+KEY = ('day', 'currency', 'status', 'livemode')
+Totals = namedtuple('Totals', ('transactions', 'gross', 'fees', 'chargebacks', 'refunds',
+    'refunded'))
+EMPTY = Totals(0, 0, 0, 0, 0, 0)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS totals (
+    day TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    status TEXT NOT NULL,
+    livemode INTEGER NOT NULL,
+    {0},
+    PRIMARY KEY (day, currency, status, livemode)
+);
+CREATE TABLE IF NOT EXISTS contributions (
+    id TEXT PRIMARY KEY,
+    transaction_id TEXT,
+    updated_at INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    status TEXT NOT NULL,
+    livemode INTEGER NOT NULL,
+    {0}
+);
+CREATE INDEX IF NOT EXISTS contributions_transaction ON contributions (transaction_id);
+""".format(',\n    '.join('{0} INTEGER NOT NULL DEFAULT 0'.format(x) for x in Totals._fields))
+
+PREFIXES = {
+    'tran_': Transaction,
+    'refund_': Refund,
+}
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        # Objects hold local times, see PaymillObject
+        return int(time.mktime(value.timetuple()))
+    return int(value or 0)
+
+
+def _day(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+class SettlementAggregates(object):
+    """Running settlement totals by day × currency × status × livemode, in SQLite.
+
+    Transactions and refunds (objects, pages or webhook payloads) are fed as they are read;
+    the contribution of each object to the totals is kept, so a changed object moves its
+    amounts to its new key instead of being counted twice, and older versions of an object
+    than the one already fed are ignored. Totals per key are then read from a single row.
+
+    Days are UTC dates of creation. Gross amounts are transaction origin amounts, fees the
+    sum of the transaction fees; refunds are counted on their own day and status, in the
+    currency of their transaction.
+    """
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def _currency(self, refund, transaction):
+        transaction = transaction or refund.transaction
+        if isinstance(transaction, PaymillObject):
+            return transaction.currency or ''
+        # Unknown until the transaction is fed, see _rekey_refunds()
+        row = self._db.execute('SELECT currency FROM contributions WHERE id = ?',
+            (transaction,)).fetchone()
+        return row and row[0] or ''
+
+    def _rekey_refunds(self, transaction_id, currency):
+        """Moves refunds fed before their transaction to its currency"""
+        for row in self._db.execute(
+            'SELECT id, {0}, {1} FROM contributions WHERE transaction_id = ? AND currency != ?'
+            .format(', '.join(KEY), ', '.join(Totals._fields)), (transaction_id, currency)
+        ).fetchall():
+            key, totals = tuple(row[1:5]), Totals(*row[5:])
+            self._add(key, totals, -1)
+            self._add((key[0], currency) + key[2:], totals, 1)
+            self._db.execute('UPDATE contributions SET currency = ? WHERE id = ?',
+                (currency, row[0]))
+
+    def _contribution(self, obj, transaction=None):
+        """Returns the key of ``obj`` and its totals"""
+        day = datetime.utcfromtimestamp(_timestamp(obj.created_at)).date().isoformat()
+        if isinstance(obj, Transaction):
+            fees = sum(int(x.get('amount') or 0) for x in obj.fees or ())
+            return (day, obj.currency or '', obj.status or '', int(bool(obj.livemode))), Totals(
+                1, int(obj.origin_amount or 0), fees, int(obj.status == 'chargeback'), 0, 0)
+        return (day, self._currency(obj, transaction), obj.status or '',
+            int(bool(obj.livemode))), Totals(0, 0, 0, 0, 1, int(obj.amount or 0))
+
+    def _add(self, key, totals, sign):
+        self._db.execute('INSERT OR IGNORE INTO totals ({0}) VALUES (?, ?, ?, ?)'.format(
+            ', '.join(KEY)), key)
+        self._db.execute('UPDATE totals SET {0} WHERE {1}'.format(
+            ', '.join('{0} = {0} + ?'.format(x) for x in Totals._fields),
+            ' AND '.join('{0} = ?'.format(x) for x in KEY)
+        ), tuple(sign * x for x in totals) + key)
+        if sign < 0:
+            self._db.execute('DELETE FROM totals WHERE {0} AND {1}'.format(
+                ' AND '.join('{0} = ?'.format(x) for x in KEY),
+                ' AND '.join('{0} = 0'.format(x) for x in Totals._fields)
+            ), key)
+
+    def _apply(self, obj, transaction=None):
+        updated_at = _timestamp(obj.updated_at)
+        key, totals = self._contribution(obj, transaction)
+        row = self._db.execute(
+            'SELECT updated_at, {0}, {1} FROM contributions WHERE id = ?'.format(
+                ', '.join(KEY), ', '.join(Totals._fields)), (obj.id,)
+        ).fetchone()
+
+        if row is not None:
+            old_key, old_totals = tuple(row[1:5]), Totals(*row[5:])
+            if row[0] > updated_at or (old_key, old_totals) == (key, totals):
+                return False
+            self._add(old_key, old_totals, -1)
+
+        transaction_id = None
+        if isinstance(obj, Refund):
+            transaction_id = getattr(transaction or obj.transaction, 'id',
+                transaction or obj.transaction)
+
+        self._add(key, totals, 1)
+        self._db.execute(
+            'INSERT OR REPLACE INTO contributions (id, transaction_id, updated_at, {0}, {1})'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(
+                ', '.join(KEY), ', '.join(Totals._fields)),
+            (obj.id, transaction_id, updated_at) + key + totals
+        )
+        if isinstance(obj, Transaction):
+            self._rekey_refunds(obj.id, key[1])
+        return True
+
+    def _objects(self, objects):
+        for x in objects:
+            if isinstance(x, PaymillList):
+                for y in x:
+                    yield y
+            else:
+                yield x
+
+    def feed(self, objects):
+        """Updates the totals with transactions and refunds (refunds of transactions too),
+        returns the number of objects which changed them"""
+        changed = 0
+        with self._lock, self._db:
+            for obj in self._objects(objects):
+                if isinstance(obj, Transaction):
+                    changed += self._apply(obj)
+                    for refund in obj.refunds or ():
+                        if isinstance(refund, Refund):
+                            changed += self._apply(refund, obj)
+                elif isinstance(obj, Refund):
+                    changed += self._apply(obj)
+        return changed
+
+    def feed_webhook(self, payload):
+        """Updates the totals with the transactions and refunds of a webhook payload (a dict or
+        JSON), returns the number of objects which changed them"""
+        if not isinstance(payload, dict):
+            payload = json.loads(payload)
+        resource = payload.get('event', payload).get('event_resource') or {}
+        # Resources are either an object or objects by name (e.g. subscription events)
+        if 'id' in resource:
+            resource = {'resource': resource}
+
+        objects = []
+        for data in resource.values():
+            if isinstance(data, dict):
+                for prefix, cls in PREFIXES.items():
+                    if data.get('id', '').startswith(prefix):
+                        objects.append(cls(**data))
+        return self.feed(objects)
+
+    def get(self, day, currency, status, livemode=True):
+        """Returns the totals of a key"""
+        with self._lock:
+            row = self._db.execute('SELECT {0} FROM totals WHERE {1}'.format(
+                ', '.join(Totals._fields), ' AND '.join('{0} = ?'.format(x) for x in KEY)
+            ), (_day(day), currency, status, int(livemode))).fetchone()
+        return row and Totals(*row) or EMPTY
+
+    def rows(self, start=None, end=None, **filters):
+        """Returns (day, currency, status, livemode, totals) tuples of the days from ``start``
+        to ``end`` (inclusive), filtered by currency, status or livemode"""
+        where = []
+        params = []
+        if start is not None:
+            where.append('day >= ?')
+            params.append(_day(start))
+        if end is not None:
+            where.append('day <= ?')
+            params.append(_day(end))
+        for k, v in sorted(filters.items()):
+            if k not in KEY[1:]:
+                raise ValueError('Unknown filter: {0}'.format(k))
+            where.append('{0} = ?'.format(k))
+            params.append(k == 'livemode' and int(v) or v)
+
+        with self._lock:
+            rows = self._db.execute('SELECT {0}, {1} FROM totals {2} ORDER BY {0}'.format(
+                ', '.join(KEY), ', '.join(Totals._fields),
+                where and 'WHERE ' + ' AND '.join(where) or ''
+            ), params).fetchall()
+        return [(x[0], x[1], x[2], bool(x[3]), Totals(*x[4:])) for x in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -2,10 +2,13 @@
 from __future__ import (print_function, division, absolute_import, unicode_literals)
 
 import base64
+from contextlib import contextmanager
 from datetime import date, datetime
+from functools import partial, wraps
 import json
 import logging
 import re
+import threading
 import time
 from urllib import urlencode
 from urllib2 import (
@@ -13,6 +16,16 @@ from urllib2 import (
     HTTPSHandler, HTTPDefaultErrorHandler, HTTPErrorProcessor
 )
 
+from .compress import DecompressProcessor
+from .connection import KeepAliveHandler
+from .hedge import Hedger
+from .limiter import AdaptiveLimiter
+from .priority import PriorityScheduler
+from .profiling import Profiler
+from .query import Query
+from .http2 import HAS_HTTP2, HTTP2Handler
+from .trace import NOOP_SPAN
+
 __all__ = ('Paymill', 'PaymillError')
 
 BASE_URL = 'https://api.paymill.com/v2/'
@@ -66,6 +79,19 @@ DETAILED_ERRORS = {
 RE_INT = re.compile(r'^[0-9]+$')
 RE_INTERVAL = re.compile(r'^[0-9]*\ ?(DAY|WEEK|MONTH|YEAR)$', re.I)
 
+EMPTY_STRINGS = frozenset(('', str(None)))
+
+
+def _is_empty(value):
+    """Same as ``value in Paymill.EMPTY`` without comparing against each member"""
+    if value is None:
+        return True
+    if isinstance(value, basestring):
+        return value in EMPTY_STRINGS
+    if isinstance(value, list):
+        return not value
+    return False
+
 
 class HTTPRequest(Request):
     def __init__(self, method=None, *args, **kwargs):
@@ -79,9 +105,103 @@ class HTTPRequest(Request):
 class PaymillError(Exception):
     def __init__(self, code, message, data=None):
         super(PaymillError, self).__init__(self, code, message)
+        self.code = code
         self.data = data
 
 
+class Metrics(object):
+    """Thread-safe counters of a client activity"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def __getitem__(self, name):
+        return self._values.get(name, 0)
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._values)
+
+
+_LOCAL = threading.local()
+
+
+class IdentityMap(object):
+    """Shares objects decoded while it is active.
+
+    Nested objects with the same type, ``id`` and ``updated_at`` are built once and shared,
+    as are timestamps and repeated strings (currency, status, card type...). Use it as a
+    context manager to share objects between the calls made by the current thread, or
+    ``Paymill(..., identity_map=True)`` for one map per response. Calls run for that thread by
+    others (hedged requests, ``resolve()``, ``PaymillPool.fan_out()``) share them too, see
+    ``wrap()``. A shared object is the same instance everywhere it appears: changing it changes
+    it everywhere.
+    """
+    INTERNED = ('currency', 'status', 'card_type', 'type', 'country', 'interval', 'app_id')
+
+    def __init__(self):
+        self.objects = {}
+        self.strings = {}
+        self.datetimes = {}
+        self._previous = []
+
+    def build(self, cls, data):
+        key = (cls, data.get('id'), data.get('updated_at'))
+        if key[1] is None:
+            return cls(**data)
+
+        obj = self.objects.get(key)
+        if obj is None:
+            # Threads sharing the map keep the first object built
+            obj = self.objects.setdefault(key, cls(**data))
+        return obj
+
+    def datetime(self, timestamp):
+        value = self.datetimes.get(timestamp)
+        if value is None:
+            value = self.datetimes.setdefault(timestamp, datetime.fromtimestamp(timestamp))
+        return value
+
+    def intern(self, value):
+        return self.strings.setdefault(value, value)
+
+    def __enter__(self):
+        self._previous.append(getattr(_LOCAL, 'identity_map', None))
+        _LOCAL.identity_map = self
+        return self
+
+    def __exit__(self, *args):
+        _LOCAL.identity_map = self._previous.pop()
+
+    @staticmethod
+    def wrap(func):
+        """Returns ``func`` running with the active map of the current thread, e.g. in a
+        thread pool"""
+        identity_map = getattr(_LOCAL, 'identity_map', None)
+        if identity_map is None:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = getattr(_LOCAL, 'identity_map', None)
+            _LOCAL.identity_map = identity_map
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _LOCAL.identity_map = previous
+        return wrapper
+
+
+def _build(cls, data, identity_map=None):
+    if identity_map is None:
+        return cls(**data)
+    return identity_map.build(cls, data)
+
+
 class PaymillObjectEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime):
@@ -89,8 +209,9 @@ class PaymillObjectEncoder(json.JSONEncoder):
 
     def _iterencode(self, obj, markers=None):
         if isinstance(obj, PaymillObject):
+            data = dict((k, v) for k, v in obj.__dict__.items() if not k.startswith('_'))
             for i, x in enumerate(super(PaymillObjectEncoder, self)
-            ._iterencode(obj.__dict__, markers)):
+            ._iterencode(data, markers)):
                 if i == 1:
                     yield '  // {0}'.format(type(obj))
                 yield x
@@ -107,6 +228,8 @@ class PaymillBase(type):
 
         fields = getattr(meta, 'fields', [])
         typed_fields = getattr(meta, 'typed_fields', {})
+        attrs['_fields'] = tuple(fields)
+        attrs['_updatable'] = frozenset(getattr(meta, 'updatable', ()))
 
         for f in fields:
             if f in typed_fields:
@@ -123,6 +246,7 @@ class PaymillObject(object):
     __metaclass__ = PaymillBase
 
     def __init__(self, **kwargs):
+        identity_map = getattr(_LOCAL, 'identity_map', None)
         self.__dict__.update(self._base_fields)
         self.__dict__.update(kwargs)
 
@@ -130,17 +254,58 @@ class PaymillObject(object):
             if k in self.__dict__ and self.__dict__[k] is not None:
                 callback = globals()[v]
 
+                # Bare IDs are kept, see resolve.resolve()
                 if isinstance(self.__dict__[k], (list, tuple)):
                     self.__dict__[k] = [
-                        callback(**x) for x in self.__dict__[k]
-                        if isinstance(x, dict)
+                        isinstance(x, dict) and _build(callback, x, identity_map) or x
+                        for x in self.__dict__[k] if isinstance(x, (dict, basestring))
                     ]
                 elif isinstance(self.__dict__[k], dict):
-                    self.__dict__[k] = callback(**self.__dict__[k])
+                    self.__dict__[k] = _build(callback, self.__dict__[k], identity_map)
 
         for x in ('created_at', 'updated_at'):
             if x in self.__dict__:
-                self.__dict__[x] = datetime.fromtimestamp(self.__dict__[x])
+                if identity_map is None:
+                    self.__dict__[x] = datetime.fromtimestamp(self.__dict__[x])
+                else:
+                    self.__dict__[x] = identity_map.datetime(self.__dict__[x])
+
+        if identity_map is not None:
+            for x in identity_map.INTERNED:
+                if isinstance(self.__dict__.get(x), basestring):
+                    self.__dict__[x] = identity_map.intern(self.__dict__[x])
+
+    def __setattr__(self, name, value):
+        # Original values of updatable fields are kept until saved, see save()
+        if name in self._updatable:
+            original = self.__dict__.setdefault('_original', {})
+            if name not in original:
+                original[name] = self.__dict__.get(name)
+        super(PaymillObject, self).__setattr__(name, value)
+
+    def changed(self):
+        """Returns the updatable fields changed since the object was built or saved"""
+        return dict(
+            (k, self.__dict__[k]) for k, v in self.__dict__.get('_original', {}).items()
+            if self.__dict__[k] != v
+        )
+
+    def save(self, api):
+        """Sends the changed fields with the update method of ``api`` (a Paymill client or an
+        Outbox). Returns False, without any request, if nothing changed or the update method
+        sent nothing (e.g. only fields set to None); the changes are then kept."""
+        changes = self.changed()
+        if not changes:
+            return False
+
+        update = getattr(api, 'update_{0}'.format(type(self).__name__.lower()))
+        result = update(self.id, **changes)
+        if result is None or result is False:
+            return False
+        if isinstance(result, type(self)):
+            self.__dict__.update(result.__dict__)
+        self.__dict__.pop('_original', None)
+        return True
 
     def __str__(self):
         if hasattr(self, 'id'):
@@ -168,6 +333,7 @@ class Client(PaymillObject):
             'created_at',    # unix timestamp identifying time of creation
             'updated_at',    # unix timestamp identifying time of last change
         )
+        updatable = ('email', 'description')
         typed_fields = {
             'payment': 'Payment',
             'subscription': 'Subscription',
@@ -191,6 +357,7 @@ class Offer(PaymillObject):
             'app_id',              # string or null App (ID) that created this offer
                                    # or null if created by yourself.
         )
+        updatable = ('name',)
 
 
 class Payment(PaymillObject):
@@ -213,6 +380,9 @@ class Payment(PaymillObject):
             'app_id',              # string or null App (ID) that created this payment
                                    # or null if created by yourself.
         )
+        typed_fields = {
+            'client': 'Client',
+        }
 
 
 class Preauthorization(PaymillObject):
@@ -270,6 +440,7 @@ class Transaction(PaymillObject):
             'app_id',            # string or null App (ID) that created this transaction or null if
                                  # created by yourself.
         )
+        updatable = ('description',)
         typed_fields = {
             'payment': 'Payment',
             'client': 'Client',
@@ -291,6 +462,9 @@ class Refund(PaymillObject):
             'created_at',   # unix timestamp identifying time of creation
             'updated_at',   # unix timestamp identifying time of last change
         )
+        typed_fields = {
+            'transaction': 'Transaction',
+        }
 
 
 class Subscription(PaymillObject):
@@ -314,6 +488,7 @@ class Subscription(PaymillObject):
             'app_id',                # string or null App (ID) that created this subscription or
                                      # null if created by yourself.
         )
+        updatable = ('offer',)
         typed_fields = {
             'offer': 'Offer',
             'payment': 'Payment',
@@ -323,7 +498,8 @@ class Subscription(PaymillObject):
     def __init__(self, **kwargs):
         super(Subscription, self).__init__(**kwargs)
         if self.offer == []:
-            self.offer = None
+            # Not a change, see save()
+            self.__dict__['offer'] = None
 
 
 class Webhook(PaymillObject):
@@ -337,13 +513,130 @@ class Webhook(PaymillObject):
             'app_id',       # string or null App (ID) that created this webhook or null if
                             # created by yourself.
         )
+        updatable = ('url', 'email', 'event_types')
+
+
+# Objects returned by each list endpoint
+RESOURCES = {
+    'clients': Client,
+    'offers': Offer,
+    'payments': Payment,
+    'preauthorizations': Preauthorization,
+    'refunds': Refund,
+    'subscriptions': Subscription,
+    'transactions': Transaction,
+    'webhooks': Webhook,
+}
+
+
+def decode_data(json_data, return_type=None, identity_map=False):
+    """Builds Paymill objects (or a PaymillList) from a decoded API response.
+
+    With ``identity_map``, repeated objects are shared within the response unless an
+    IdentityMap is already active.
+    """
+    if 'data' not in json_data:
+        raise Exception(json_data)
+    if not return_type:
+        return json_data
+
+    current = getattr(_LOCAL, 'identity_map', None)
+    if identity_map and current is None:
+        with IdentityMap():
+            return decode_data(json_data, return_type)
+
+    data = json_data['data']
+    if isinstance(data, dict):
+        return _build(return_type, data, current)
+    elif isinstance(data, (list, tuple)):
+        return PaymillList(
+            int(json_data.get('data_count', 0)),
+            [_build(return_type, x, current) for x in data]
+        )
 
 
 class Paymill(object):
     EMPTY = (None, str(None), '', [])
+    HANDLERS = (HTTPSHandler, HTTPDefaultErrorHandler, HTTPErrorProcessor)
 
-    def __init__(self, private_key):
+    def __init__(self, private_key, base_url=BASE_URL, handlers=None, max_connections=None,
+    http2=False, compress=False, hedge=None, limiter=None, scheduler=None, identity_map=False,
+    tracer=None, profiler=None):
+        self.base_url = base_url
+        self.handlers = tuple(handlers or ())
         self.private_key = private_key
+        self.identity_map = identity_map
+        self.metrics = Metrics()
+
+        # gzip/deflate responses, sizes are reported in metrics
+        if compress:
+            self.handlers += (DecompressProcessor(self.metrics),)
+
+        # Persistent connections, shared by all openers of this client
+        self.connections = None
+        if max_connections:
+            self.connections = KeepAliveHandler(max_connections)
+            self.handlers = (self.connections,) + self.handlers
+
+        # Multiplexed HTTP/2 connection, hosts without HTTP/2 go through the handlers above
+        self.http2 = None
+        if http2:
+            if HAS_HTTP2:
+                self.http2 = HTTP2Handler()
+                self.handlers = (self.http2,) + self.handlers
+            else:
+                LOGGER.warning('HTTP/2 requires the "hyper" package, using HTTP/1.1')
+
+        # Duplicates slow single object reads, True for default settings
+        self.hedger = hedge is True and Hedger() or hedge or None
+
+        # Adaptive bound of requests in flight, True for default settings
+        self.limiter = limiter is True and AdaptiveLimiter() or limiter or None
+
+        # Interactive calls first, True for default settings
+        self.scheduler = scheduler is True and PriorityScheduler() or scheduler or None
+
+        # Spans of calls and their stages, see trace.Tracer
+        self.tracer = tracer
+
+        # Sampled profiles and slow-call log, True for default settings
+        self.profiler = profiler is True and Profiler() or profiler or None
+
+    def close(self):
+        """Closes idle persistent connections"""
+        if self.connections is not None:
+            self.connections.close()
+        if self.http2 is not None:
+            self.http2.close()
+        if self.hedger is not None:
+            self.hedger.close()
+
+    @property
+    def private_key(self):
+        return self._private_key
+
+    @private_key.setter
+    def private_key(self, value):
+        # Authorization header and openers only depend on the key, build them once.
+        self._private_key = value
+        self._headers = {
+            'Authorization': 'Basic {0}'.format(
+                base64.standard_b64encode('{0}:'.format(value)))
+        }
+        self._openers = {}
+
+    def _get_opener(self, headers=None):
+        """Returns a cached opener with authorization and extra headers set"""
+        key = headers and tuple(sorted(headers.items())) or ()
+        opener = self._openers.get(key)
+        if opener is None:
+            opener = build_opener(*(self.HANDLERS + self.handlers))
+            _headers = dict(self._headers)
+            _headers.update(headers or {})
+            opener.addheaders = _headers.items()
+            self._openers[key] = opener
+
+        return opener
 
     def _urlencode(self, params, doseq=True):
         """urlencode after removing empty and null values"""
@@ -353,11 +646,11 @@ class Paymill(object):
 
         for k, v in params:
             if isinstance(v, (list, tuple)):
-                v = [x for x in v if x not in self.EMPTY]
+                v = [x for x in v if not _is_empty(x)]
                 if not k.endswith('[]'):
                     k = '{0}[]'.format(k)
 
-            if v not in self.EMPTY:
+            if not _is_empty(v):
                 _tmp.append((k, v))
 
         return urlencode(_tmp, doseq)
@@ -375,6 +668,8 @@ class Paymill(object):
                 code = err_data.get('response_code', code)
         except:
             pass
+        finally:
+            e.close()
 
         msg = '{0}'.format(e)
         if code in ERRORS:
@@ -388,16 +683,9 @@ class Paymill(object):
         raise PaymillError(code, msg, err_data)
 
     def _prepare_call(self, endpoint, params, method, headers):
-        opener = build_opener(HTTPSHandler, HTTPDefaultErrorHandler, HTTPErrorProcessor)
-
-        auth = base64.standard_b64encode('{0}:'.format(self.private_key))
-        _headers = {
-            'Authorization': 'Basic {0}'.format(auth)
-        }
-        _headers.update(headers or {})
-        opener.addheaders = _headers.items()
+        opener = self._get_opener(headers)
 
-        url = '{0}{1}'.format(BASE_URL, endpoint)
+        url = '{0}{1}'.format(self.base_url, endpoint)
         data = None
         if params:
             params = self._urlencode(params)
@@ -408,38 +696,146 @@ class Paymill(object):
 
         return (opener, url, data)
 
+    def _span(self, name, attributes=None):
+        span = NOOP_SPAN
+        if self.tracer is not None:
+            span = self.tracer.span(name, attributes)
+        if self.profiler is not None:
+            return self.profiler.stage(name, span)
+        return span
+
     def _api_call(self, endpoint, params=None, method='GET', headers=None,
     parse_json=True, return_type=None):
-        opener, url, data = self._prepare_call(endpoint, params, method, headers)
+        request = self._request
+        if self.profiler is not None:
+            request = partial(self.profiler.call, request)
+
+        if self.hedger is not None and method == 'GET' and not endpoint.endswith('/'):
+            # Attempts run on other threads
+            if self.tracer is not None:
+                request = self.tracer.wrap(request)
+            if self.scheduler is not None:
+                request = self.scheduler.wrap(request)
+            request = IdentityMap.wrap(request)
+            return self.hedger.call(request, endpoint, params, method, headers,
+                parse_json, return_type)
+
+        return request(endpoint, params, method, headers, parse_json, return_type)
+
+    @contextmanager
+    def _call(self, endpoint, params=None, method='GET', headers=None, read=False):
+        """Opens a request and yields the response, which is closed and accounted for when the
+        block exits. With ``read``, yields the body instead, read as part of the exchange."""
+        with self._span('pmill.prepare'):
+            opener, url, data = self._prepare_call(endpoint, params, method, headers)
         req = HTTPRequest(url=url, method=method, data=data)
 
-        try:
-            response = opener.open(req)
-            if response.getcode() != 200:
-                raise PaymillError(response.getcode(), 'Unknown error')
-        except HTTPError as e:
-            self._handler_error(e)
+        lane = None
+        if self.scheduler is not None:
+            lane = self.scheduler.acquire(self.scheduler.classify(method, endpoint))
 
-        try:
-            if parse_json:
-                json_data = json.load(response)
-                if 'data' in json_data:
-                    if return_type:
-                        if isinstance(json_data['data'], dict):
-                            return return_type(**json_data['data'])
-                        elif isinstance(json_data['data'], (list, tuple)):
-                            return PaymillList(
-                                int(json_data.get('data_count', 0)),
-                                [return_type(**x) for x in json_data['data']]
-                            )
-                    else:
-                        return json_data
-                else:
-                    raise Exception(json_data)
+        # Latency baselines of the limiter by kind of call, e.g. "GET clients/" (list pages)
+        # and "GET clients/:id"
+        path = endpoint.partition('?')[0]
+        key = '{0} {1}'.format(method, path.endswith('/') and path
+            or '{0}/:id'.format(path.partition('/')[0]))
 
-            return response.read()
+        error = None
+        limiter = self.limiter
+        start = limiter is not None and limiter.acquire() or time.time()
+        try:
+            # Parameters are left out of spans, they may hold personal data
+            with self._span('pmill.http', {'http.method': method,
+            'http.url': url.partition('?')[0]}) as span:
+                if span.traceparent is not None:
+                    req.add_header('Traceparent', span.traceparent)
+                try:
+                    response = opener.open(req)
+                except HTTPError as e:
+                    span.set_attribute('http.status_code', e.getcode())
+                    self._handler_error(e)
+
+                span.set_attribute('http.status_code', response.getcode())
+                if response.getcode() != 200:
+                    response.close()
+                    raise PaymillError(response.getcode(), 'Unknown error')
+
+                if read:
+                    try:
+                        body = response.read()
+                    finally:
+                        response.close()
+
+            if read:
+                # The limiter times the network exchange only, not the decoding of the body
+                if limiter is not None:
+                    limiter.release(start, None, key)
+                    limiter = None
+                yield body
+            else:
+                try:
+                    yield response
+                finally:
+                    response.close()
+        except Exception as e:
+            error = e
+            self.metrics.incr('errors')
+            raise
+        finally:
+            self.metrics.incr('calls')
+            self.metrics.incr('time', time.time() - start)
+            if limiter is not None:
+                limiter.release(start, error, key)
+            if lane is not None:
+                self.scheduler.release(lane)
+
+    def _request(self, endpoint, params=None, method='GET', headers=None,
+    parse_json=True, return_type=None):
+        with self._span('pmill.request', {'paymill.endpoint': endpoint,
+        'http.method': method}) as span:
+            try:
+                with self._call(endpoint, params, method, headers, read=True) as body:
+                    # Other responses raise
+                    span.set_attribute('http.status_code', 200)
+                    if not parse_json:
+                        return body
+
+                    with self._span('pmill.decode'):
+                        json_data = json.loads(body)
+                    with self._span('pmill.build'):
+                        return decode_data(json_data, return_type, self.identity_map)
+            except PaymillError as e:
+                span.set_attribute('paymill.error_code', e.code)
+                raise
+
+    # Queries over list endpoints, see query.Query
+    clients = property(lambda self: Query(self, 'clients'))
+    offers = property(lambda self: Query(self, 'offers'))
+    payments = property(lambda self: Query(self, 'payments'))
+    preauthorizations = property(lambda self: Query(self, 'preauthorizations'))
+    refunds = property(lambda self: Query(self, 'refunds'))
+    subscriptions = property(lambda self: Query(self, 'subscriptions'))
+    transactions = property(lambda self: Query(self, 'transactions'))
+    webhooks = property(lambda self: Query(self, 'webhooks'))
+
+    def iter_pages(self, resource, count=100, offset=0, **params):
+        """Yields pages (PaymillList) of a list endpoint (e.g. "transactions") until the end"""
+        # Parent of the page requests, not current while pages are used
+        span = self._span('pmill.iter_pages', {'paymill.resource': resource})
+        try:
+            while True:
+                with span.activate():
+                    page = self._api_call('{0}/'.format(resource),
+                        params=dict(params, count=count, offset=offset),
+                        return_type=RESOURCES[resource]
+                    )
+                yield page
+
+                offset += len(page)
+                if not page or offset >= page.data_count:
+                    break
         finally:
-            response.close()
+            span.finish()
 
     #
     # Payments
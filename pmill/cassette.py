@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import base64
+from collections import defaultdict
+import gzip
+import httplib
+import io
+import json
+from StringIO import StringIO
+import threading
+import time
+from urllib import addinfourl
+from urllib2 import BaseHandler, URLError
+from urlparse import urlsplit
+
+__all__ = ('Cassette', 'RecordProcessor', 'ReplayHandler')
+
+REDACTED = '<redacted>'
+
+
+class Cassette(object):
+    """Recorded request/response pairs, stored as JSON lines (gzip compressed for ".gz" paths).
+
+    Interactions are appended to the file as they are recorded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.interactions = []
+        self._lock = threading.Lock()
+        self._fp = None
+
+    def _open(self, mode):
+        if self.path.endswith('.gz'):
+            return gzip.open(self.path, mode)
+        return io.open(self.path, mode)
+
+    def load(self):
+        with self._open('rb') as fp:
+            self.interactions = [json.loads(x) for x in fp if x.strip()]
+        return self
+
+    def append(self, interaction):
+        line = json.dumps(interaction, sort_keys=True, separators=(',', ':'))
+        with self._lock:
+            self.interactions.append(interaction)
+            if self._fp is None:
+                self._fp = self._open('ab')
+            self._fp.write(line.encode('utf-8') + b'\n')
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+def _encode_body(interaction, body):
+    try:
+        interaction['body'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        interaction['body_b64'] = base64.b64encode(body)
+
+
+def _decode_body(interaction):
+    if 'body_b64' in interaction:
+        return base64.b64decode(interaction['body_b64'])
+    return interaction['body'].encode('utf-8')
+
+
+class RecordProcessor(BaseHandler):
+    """Records every exchange (with decoded bodies) to a cassette.
+
+    The Authorization header, which holds the private key, is redacted.
+    """
+    # After decompression, before HTTPErrorProcessor so errors are recorded too
+    handler_order = 950
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    def http_request(self, req):
+        req._record_start = time.time()
+        return req
+
+    def http_response(self, req, response):
+        body = response.read()
+        response.close()
+
+        url = urlsplit(req.get_full_url())
+        interaction = {
+            'method': req.get_method(),
+            'path': url.path,
+            'query': url.query,
+            'data': req.get_data(),
+            'headers': dict(
+                (k, k.lower() == 'authorization' and REDACTED or v) for k, v in req.header_items()
+            ),
+            'status': response.code,
+            'content_type': response.info().getheader('Content-Type'),
+            'elapsed': round(time.time() - req._record_start, 4),
+        }
+        _encode_body(interaction, body)
+        self.cassette.append(interaction)
+
+        resp = addinfourl(StringIO(body), response.info(), response.geturl())
+        resp.code = response.code
+        resp.msg = response.msg
+        return resp
+
+    https_request = http_request
+    https_response = http_response
+
+
+class ReplayHandler(BaseHandler):
+    """Serves responses from a cassette instead of the network.
+
+    Requests are matched on method, path, query and body, then on method and path only.
+    Several recordings of the same request are served in turn. With ``speed`` set, recorded
+    latencies are replayed, divided by ``speed``.
+    """
+    handler_order = 100
+
+    def __init__(self, cassette, speed=None):
+        self.speed = speed
+        self._exact = defaultdict(list)
+        self._loose = defaultdict(list)
+        self._served = defaultdict(int)
+        self._lock = threading.Lock()
+
+        for x in cassette.interactions:
+            self._exact[(x['method'], x['path'], x['query'], x['data'])].append(x)
+            self._loose[(x['method'], x['path'])].append(x)
+
+    def _find(self, req):
+        url = urlsplit(req.get_full_url())
+        for index, key in (
+            (self._exact, (req.get_method(), url.path, url.query, req.get_data())),
+            (self._loose, (req.get_method(), url.path)),
+        ):
+            candidates = index.get(key)
+            if candidates:
+                with self._lock:
+                    self._served[key] += 1
+                    return candidates[(self._served[key] - 1) % len(candidates)]
+
+        raise URLError('No recorded response for {0} {1}'.format(req.get_method(), url.path))
+
+    def http_open(self, req):
+        interaction = self._find(req)
+        if self.speed:
+            time.sleep(interaction['elapsed'] / self.speed)
+
+        headers = httplib.HTTPMessage(StringIO('Content-Type: {0}\r\n'.format(
+            interaction.get('content_type') or 'application/json'
+        )))
+        resp = addinfourl(StringIO(_decode_body(interaction)), headers, req.get_full_url())
+        resp.code = interaction['status']
+        resp.msg = httplib.responses.get(resp.code, '')
+        return resp
+
+    https_open = http_open
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Paymill command line tools.
+
+    pmill export transactions --format csv --output transactions.csv \\
+        --since 2016-01-01 --until 2016-07-01 --checkpoint transactions.ckpt
+
+The private key is read from --key or the PAYMILL_PRIVATE_KEY environment variable.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import argparse
+import calendar
+from datetime import datetime
+import os
+import sys
+
+from .api import BASE_URL, RESOURCES, Paymill
+from .export import FORMATS, Exporter
+
+__all__ = ('main',)
+
+
+def timestamp(value):
+    """Unix timestamp or YYYY-MM-DD date (UTC)"""
+    if value.isdigit():
+        return int(value)
+    return calendar.timegm(datetime.strptime(value, '%Y-%m-%d').timetuple())
+
+
+def export(options):
+    if options.format == 'parquet':
+        try:
+            import pyarrow  # NOQA
+        except ImportError:
+            sys.exit('Parquet export requires pyarrow (pip install pmill[parquet])')
+
+    api = Paymill(options.key, base_url=options.base_url, max_connections=options.workers)
+    try:
+        exporter = Exporter(api, options.resource, count=options.count, workers=options.workers,
+            checkpoint=options.checkpoint)
+        output = options.output or '{0}.{1}'.format(options.resource, options.format)
+        count = exporter.export(output, options.format, since=options.since,
+            until=options.until)
+    finally:
+        api.close()
+
+    print('{0} {1} exported to {2}'.format(count, options.resource, output), file=sys.stderr)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='pmill', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--key', default=os.environ.get('PAYMILL_PRIVATE_KEY'),
+        help='private key')
+    parser.add_argument('--base-url', default=BASE_URL, help='API URL')
+    commands = parser.add_subparsers()
+
+    p = commands.add_parser('export', help='export a whole collection')
+    p.set_defaults(func=export)
+    p.add_argument('resource', choices=sorted(RESOURCES))
+    p.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+    p.add_argument('--output', help='file (directory for parquet), default: <resource>.<format>')
+    p.add_argument('--since', type=timestamp, help='created at or after (date or timestamp)')
+    p.add_argument('--until', type=timestamp,
+        help='created at or before, default: now (the checkpoint end when resuming)')
+    p.add_argument('--count', type=int, default=100, help='page size')
+    p.add_argument('--workers', type=int, default=8, help='number of parallel page fetches')
+    p.add_argument('--checkpoint', help='progress file, an interrupted export resumes from it')
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    options = parser.parse_args(argv)
+    if not options.key:
+        parser.error('a private key is required (--key or PAYMILL_PRIVATE_KEY)')
+    options.func(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import socket
+from urllib import addinfourl
+from urllib2 import BaseHandler
+import zlib
+
+__all__ = ('DecompressProcessor',)
+
+CHUNK_SIZE = 16384
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class DecompressingSocket(object):
+    """Socket-like wrapper decompressing a response body chunk by chunk"""
+    def __init__(self, fp, encoding, metrics=None):
+        self._fp = fp
+        self._encoding = encoding
+        self._metrics = metrics
+        self._decompressor = zlib.decompressobj(WBITS[encoding])
+        self._pending = b''
+        self._started = False
+        self._received = 0
+        self._decoded = 0
+
+    def _decompress(self, size):
+        try:
+            data = self._decompressor.decompress(self._pending, size)
+        except zlib.error:
+            # Some servers send raw deflate streams instead of zlib ones
+            if self._started or self._encoding != 'deflate':
+                raise
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self._decompressor.decompress(self._pending, size)
+
+        self._started = True
+        self._pending = self._decompressor.unconsumed_tail
+        return data
+
+    def recv(self, size):
+        data = b''
+        while not data:
+            if not self._pending:
+                chunk = self._fp.read(CHUNK_SIZE)
+                if not chunk:
+                    data = self._decompressor.flush()
+                    self._decoded += len(data)
+                    self._report()
+                    return data
+
+                self._received += len(chunk)
+                self._pending = chunk
+
+            data = self._decompress(size)
+
+        self._decoded += len(data)
+        return data
+
+    def _report(self):
+        metrics, self._metrics = self._metrics, None
+        if metrics is not None:
+            metrics.incr('bytes_received', self._received)
+            metrics.incr('bytes_decoded', self._decoded)
+            metrics.incr('bytes_saved', self._decoded - self._received)
+
+    def close(self):
+        self._report()
+        self._fp.close()
+
+
+class DecompressProcessor(BaseHandler):
+    """Asks for gzip or deflate compressed responses and decompresses them on the fly.
+
+    Compressed and decoded sizes are added to ``metrics`` once a body is read.
+    """
+    # Before HTTPErrorProcessor, so error bodies are decoded as well
+    handler_order = 900
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+
+    def http_request(self, req):
+        req.add_unredirected_header('Accept-Encoding', 'gzip, deflate')
+        return req
+
+    def http_response(self, req, response):
+        headers = response.info()
+        encoding = (headers.getheader('Content-Encoding') or '').strip().lower()
+        if encoding not in WBITS:
+            return response
+
+        del headers['Content-Encoding']
+        del headers['Content-Length']
+
+        sock = DecompressingSocket(response, encoding, self.metrics)
+        resp = addinfourl(socket._fileobject(sock, close=True), headers, response.geturl())
+        resp.code = response.code
+        resp.msg = response.msg
+        return resp
+
+    https_request = http_request
+    https_response = http_response
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from functools import partial
+import httplib
+import socket
+import threading
+from urllib import addinfourl
+from urllib2 import AbstractHTTPHandler, URLError
+
+__all__ = ('ConnectionBudget', 'KeepAliveHandler')
+
+
+class ConnectionBudget(object):
+    """Bounds the number of connections opened by a group of handlers.
+
+    When the budget is exhausted, ``reclaim`` is called to close idle connections somewhere
+    else; it returns False when nothing could be freed, the caller then waits for a release.
+    """
+    def __init__(self, max_connections, reclaim=None):
+        self.max_connections = max_connections
+        self.reclaim = reclaim
+        self._cond = threading.Condition()
+        self._open = 0
+
+    @property
+    def open_connections(self):
+        return self._open
+
+    def acquire(self):
+        while True:
+            with self._cond:
+                if self._open < self.max_connections:
+                    self._open += 1
+                    return
+
+            if self.reclaim is None or not self.reclaim():
+                with self._cond:
+                    if self._open >= self.max_connections:
+                        self._cond.wait(0.1)
+
+    def release(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+
+class PooledSocket(object):
+    """Socket-like wrapper around a response, giving its connection back once fully read"""
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+
+    def recv(self, size):
+        data = self._response.read(size)
+        if self._response.isclosed():
+            self.close(reuse=True)
+        return data
+
+    def close(self, reuse=False):
+        release, self._release = self._release, None
+        if release is not None:
+            release(reuse and not self._response.will_close)
+
+
+class KeepAliveHandler(AbstractHTTPHandler):
+    """HTTP(S) handler reusing persistent connections, with at most ``max_connections``
+    requests in flight."""
+    handler_order = 400
+
+    def __init__(self, max_connections=4, debuglevel=0, context=None, budget=None):
+        AbstractHTTPHandler.__init__(self, debuglevel)
+        self.max_connections = max_connections
+        self.budget = budget
+        self.reuse = True
+        self._context = context
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._open = 0
+
+    @property
+    def open_connections(self):
+        return self._open
+
+    @property
+    def idle_connections(self):
+        with self._lock:
+            return sum(len(x) for x in self._idle.values())
+
+    @property
+    def busy(self):
+        return self.open_connections > self.idle_connections
+
+    def close(self):
+        """Closes all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+                self._closed()
+
+    def _closed(self):
+        with self._lock:
+            self._open -= 1
+        if self.budget is not None:
+            self.budget.release()
+
+    def _new_connection(self, key, timeout, tunnel_headers, **kwargs):
+        http_class, host, tunnel_host = key
+        conn = http_class(host, timeout=timeout, **kwargs)
+        if tunnel_host:
+            # HTTPS through a proxy, see AbstractHTTPHandler.do_open
+            conn.set_tunnel(tunnel_host, headers=tunnel_headers)
+        return conn
+
+    def _connect(self, key, timeout, tunnel_headers, **kwargs):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop(), True
+
+        if self.budget is not None:
+            self.budget.acquire()
+        with self._lock:
+            self._open += 1
+
+        return self._new_connection(key, timeout, tunnel_headers, **kwargs), False
+
+    def _release(self, key, conn, reuse):
+        if reuse and self.reuse:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+            self._closed()
+        self._slots.release()
+
+    def _request(self, conn, req, headers):
+        try:
+            conn.request(req.get_method(), req.get_selector(), req.data, headers)
+            return conn.getresponse(buffering=True)
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            raise
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        tunnel_headers = {}
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            # Sent to the proxy only, not to the origin server
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        key = (http_class, host, req._tunnel_host)
+        self._slots.acquire()
+        try:
+            conn, reused = self._connect(key, req.timeout, tunnel_headers, **http_conn_args)
+            try:
+                r = self._request(conn, req, headers)
+            except (socket.error, httplib.HTTPException) as e:
+                # A reused connection may have been dropped by the server while idle. Retry
+                # once on a fresh one, except for POST which is not safe to send twice.
+                if not reused or req.get_method() == 'POST':
+                    raise URLError(e)
+                conn = self._new_connection(key, req.timeout, tunnel_headers, **http_conn_args)
+                try:
+                    r = self._request(conn, req, headers)
+                except (socket.error, httplib.HTTPException) as e:
+                    raise URLError(e)
+        except:
+            self._closed()
+            self._slots.release()
+            raise
+
+        sock = PooledSocket(r, partial(self._release, key, conn))
+        resp = addinfourl(socket._fileobject(sock, close=True), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+    def http_open(self, req):
+        return self.do_open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self.do_open(httplib.HTTPSConnection, req, context=self._context)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import csv
+import io
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import time
+
+from .api import RESOURCES
+
+__all__ = ('Exporter', 'FORMATS')
+
+
+def _flat(value):
+    """Column value of a field: nested objects are replaced by their ID"""
+    if isinstance(value, dict):
+        return value.get('id', json.dumps(value, sort_keys=True))
+    if isinstance(value, list):
+        return json.dumps([isinstance(x, dict) and x.get('id', x) or x for x in value],
+            sort_keys=True)
+    return value
+
+
+def _open(path, position):
+    """Opens ``path`` for writing, truncated to ``position`` when resuming"""
+    if position is None:
+        return io.open(path, 'wb')
+    fp = io.open(path, 'r+b')
+    fp.truncate(position)
+    fp.seek(position)
+    return fp
+
+
+class NDJSONWriter(object):
+    """``position`` is the size of the output to keep when resuming an export"""
+
+    def __init__(self, path, fields, position=None):
+        self._fp = _open(path, position)
+
+    @property
+    def position(self):
+        return self._fp.tell()
+
+    def write(self, items):
+        for x in items:
+            self._fp.write(json.dumps(x, sort_keys=True, separators=(',', ':')) + b'\n')
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+class CSVWriter(object):
+
+    def __init__(self, path, fields, position=None):
+        self.fields = fields
+        self._fp = _open(path, position)
+        self._writer = csv.writer(self._fp)
+        if position is None:
+            self._writer.writerow([x.encode('utf-8') for x in fields])
+
+    @property
+    def position(self):
+        return self._fp.tell()
+
+    def write(self, items):
+        for x in items:
+            row = [_flat(x.get(f)) for f in self.fields]
+            self._writer.writerow([
+                isinstance(v, unicode) and v.encode('utf-8') or ('' if v is None else v)
+                for v in row
+            ])
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+class ParquetWriter(object):
+    """Writes one part file per batch in the output directory (requires pyarrow), the
+    position is the number of parts"""
+
+    def __init__(self, path, fields, position=None):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = path
+        self.fields = fields
+        self.schema = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        parts = sorted(x for x in os.listdir(path) if x.endswith('.parquet'))
+        # Parts written after the position was saved are written again
+        for x in parts[position or 0:]:
+            os.remove(os.path.join(path, x))
+        self._part = position or 0
+
+    @property
+    def position(self):
+        return self._part
+
+    def _schema(self, columns):
+        types = []
+        for name, values in zip(self.fields, columns):
+            array = self._pa.array(values)
+            # Columns without any value in the first batch are assumed to hold strings
+            types.append(self._pa.field(name,
+                array.type == self._pa.null() and self._pa.string() or array.type))
+        return self._pa.schema(types)
+
+    def write(self, items):
+        if not items:
+            return
+        columns = [[_flat(x.get(f)) for x in items] for f in self.fields]
+        if self.schema is None:
+            self.schema = self._schema(columns)
+
+        table = self._pa.Table.from_arrays(
+            [self._pa.array(c, type=f.type) for c, f in zip(columns, self.schema)],
+            schema=self.schema
+        )
+        self._pq.write_table(table,
+            os.path.join(self.path, 'part-{0:05d}.parquet'.format(self._part)))
+        self._part += 1
+
+    def close(self):
+        pass
+
+
+FORMATS = {
+    'ndjson': NDJSONWriter,
+    'csv': CSVWriter,
+    'parquet': ParquetWriter,
+}
+
+
+class Exporter(object):
+    """Dumps a whole resource collection with parallel page fetches.
+
+    Pages are fetched ``workers`` at a time in ascending creation order and written as raw API
+    objects, so memory stays bounded to one batch. After each batch, the next offset and the
+    output size are saved to ``checkpoint``. An export of the same resource to the same output
+    since the same time, restarted with the checkpoint, resumes from there with the saved end
+    time and parameters; output written after the checkpoint was saved is discarded.
+    """
+    def __init__(self, api, resource, count=100, workers=8, checkpoint=None):
+        self.api = api
+        self.resource = resource
+        self.count = count
+        self.workers = workers
+        self.checkpoint = checkpoint
+
+    def _fetch(self, params):
+        return self.api._api_call('{0}/'.format(self.resource), params=params)
+
+    def _load_checkpoint(self, state):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return None
+
+        with io.open(self.checkpoint, 'rb') as fp:
+            saved = json.load(fp)
+        for k in ('resource', 'output', 'since'):
+            if saved.get(k) != state[k]:
+                raise ValueError('Checkpoint was made for another export ({0} differs)'.format(k))
+        return saved
+
+    def _save_checkpoint(self, state):
+        if self.checkpoint:
+            tmp = '{0}.tmp'.format(self.checkpoint)
+            with io.open(tmp, 'wb') as fp:
+                json.dump(state, fp)
+            os.rename(tmp, self.checkpoint)
+
+    def export(self, output, format='ndjson', since=None, until=None, **params):
+        """Exports objects created between ``since`` and ``until`` (unix timestamps) to
+        ``output``, returns the number of exported objects."""
+        since = int(since or 0)
+        until = int(until or time.time())
+        params = dict(params, order='created_at_asc', created_at='{0}-{1}'.format(since, until))
+
+        state = {'resource': self.resource, 'output': output, 'since': since, 'until': until,
+            'params': params, 'offset': 0, 'position': None}
+        saved = self._load_checkpoint(state)
+        if saved is not None:
+            state = saved
+            params = state['params']
+
+        total = int(self._fetch(dict(params, count=1, offset=0)).get('data_count', 0))
+        writer = FORMATS[format](output, RESOURCES[self.resource]._fields,
+            position=state['position'])
+
+        pool = ThreadPool(self.workers)
+        exported = 0
+        try:
+            while state['offset'] < total:
+                offsets = range(state['offset'], total, self.count)[:self.workers]
+                pages = pool.map(self._fetch,
+                    [dict(params, count=self.count, offset=x) for x in offsets])
+
+                items = [x for page in pages for x in page['data']]
+                writer.write(items)
+                exported += len(items)
+
+                state['offset'] = offsets[-1] + self.count
+                state['position'] = writer.position
+                self._save_checkpoint(state)
+        finally:
+            pool.close()
+            writer.close()
+
+        return exported
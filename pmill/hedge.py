@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from bisect import bisect_left, insort
+from collections import deque
+from Queue import Empty, Queue
+import sys
+import threading
+import time
+
+__all__ = ('Hedger',)
+
+
+class Hedger(object):
+    """Sends a duplicate of a call which did not answer in time, the first response wins.
+
+    The hedge delay is the ``percentile`` of the last ``window`` latencies (``delay`` until
+    ``min_samples`` are known). At most ``max_ratio`` of calls get a duplicate; the slower
+    response is discarded. Each attempt runs on its own thread, so the delay is not spent
+    waiting for a worker and the concurrency of callers is not capped.
+    """
+    def __init__(self, percentile=95, delay=0.1, max_ratio=0.05, window=1000, min_samples=20):
+        self.percentile = percentile
+        self.initial_delay = delay
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+        # Latencies in arrival order (to drop the oldest) and sorted (for the percentile)
+        self._latencies = deque(maxlen=window)
+        self._sorted = []
+        self._lock = threading.Lock()
+        self._threads = set()
+
+    @property
+    def delay(self):
+        with self._lock:
+            samples = self._sorted
+            if len(samples) < self.min_samples:
+                return self.initial_delay
+            return samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
+
+    def _record(self, latency):
+        with self._lock:
+            if len(self._latencies) == self._latencies.maxlen:
+                del self._sorted[bisect_left(self._sorted, self._latencies[0])]
+            self._latencies.append(latency)
+            insort(self._sorted, latency)
+
+    def _can_hedge(self):
+        with self._lock:
+            if self.hedges + 1 > self.calls * self.max_ratio:
+                return False
+            self.hedges += 1
+            return True
+
+    def _submit(self, queue, attempt, func, args, kwargs):
+        def run():
+            try:
+                queue.put((attempt, True, func(*args, **kwargs)))
+            except Exception:
+                queue.put((attempt, False, sys.exc_info()))
+            finally:
+                with self._lock:
+                    self._threads.discard(thread)
+
+        thread = threading.Thread(target=run, name='pmill-hedge')
+        thread.daemon = True
+        with self._lock:
+            self._threads.add(thread)
+        thread.start()
+
+    def call(self, func, *args, **kwargs):
+        with self._lock:
+            self.calls += 1
+
+        queue = Queue()
+        start = time.time()
+        self._submit(queue, 0, func, args, kwargs)
+        pending = 1
+
+        try:
+            result = queue.get(timeout=self.delay)
+        except Empty:
+            if self._can_hedge():
+                self._submit(queue, 1, func, args, kwargs)
+                pending += 1
+            result = queue.get()
+
+        # An error only wins when no other attempt is left
+        while not result[1] and pending > 1:
+            pending -= 1
+            result = queue.get()
+
+        # Latency of the call, hedge delay included when the duplicate wins
+        self._record(time.time() - start)
+        attempt, ok, value = result
+        if attempt:
+            with self._lock:
+                self.hedge_wins += 1
+
+        if not ok:
+            raise value[0], value[1], value[2]
+        return value
+
+    def close(self):
+        """Waits for discarded requests still running"""
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import httplib
+import logging
+import socket
+from StringIO import StringIO
+import threading
+import time
+from urllib import addinfourl
+from urllib2 import BaseHandler, URLError
+
+try:
+    from hyper import HTTP20Connection
+    from hyper.common.exceptions import ConnectionError as HTTP2ConnectionError
+except ImportError:
+    HTTP20Connection = None
+    HTTP2ConnectionError = None
+
+__all__ = ('HAS_HTTP2', 'HTTP2Handler')
+
+LOGGER = logging.getLogger(__name__)
+HAS_HTTP2 = HTTP20Connection is not None
+
+# Headers HTTP/2 forbids or sets by itself (as :authority)
+SKIP_HEADERS = frozenset(('Host', 'Connection', 'Keep-Alive', 'Transfer-Encoding', 'Upgrade'))
+
+
+class ResponseSocket(object):
+    """Socket-like wrapper around an HTTP/2 response stream"""
+    def __init__(self, response):
+        self._response = response
+
+    def recv(self, size):
+        return self._response.read(size, decode_content=False)
+
+    def close(self):
+        self._response.close()
+
+
+class HTTP2Handler(BaseHandler):
+    """Sends all requests to a host over a single multiplexed HTTP/2 connection.
+
+    Hosts that do not negotiate HTTP/2 are remembered and left to the next handler of the
+    chain, which speaks HTTP/1.1. Cleartext hosts are not negotiated with: those failing the
+    first exchange are left to it too, the request included. Network errors say nothing about
+    the protocol: such hosts are only left to HTTP/1.1 for ``retry_after`` seconds. Requires
+    the ``hyper`` package.
+    """
+    handler_order = 300
+
+    def __init__(self, ssl_context=None, retry_after=300):
+        if not HAS_HTTP2:
+            raise ImportError('HTTP/2 support requires the "hyper" package')
+
+        self.ssl_context = ssl_context
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._connections = {}
+        # Time until which hosts use HTTP/1.1, None for good
+        self._fallback = {}
+        # Hosts which answered over HTTP/2
+        self._verified = set()
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for conn in connections.values():
+            conn.close()
+
+    def _connection(self, key):
+        with self._lock:
+            if key in self._fallback:
+                until = self._fallback[key]
+                if until is None or time.time() < until:
+                    return None
+                del self._fallback[key]
+            conn = self._connections.get(key)
+        if conn is not None:
+            return conn
+
+        # Connected without the lock, requests to other hosts are not held up meanwhile
+        host, secure = key
+        conn = HTTP20Connection(host, secure=secure, ssl_context=self.ssl_context)
+        try:
+            conn.connect()
+        except Exception as e:
+            # Negotiation failures surface as various errors depending on the server
+            self._fall_back(key, conn, e)
+            return None
+
+        with self._lock:
+            if key not in self._fallback:
+                current = self._connections.setdefault(key, conn)
+            else:
+                current = None
+        if current is not conn:
+            # Another thread connected (or fell back) first
+            conn.close()
+        return current
+
+    def _fall_back(self, key, conn, error):
+        until = None
+        if isinstance(error, socket.error):
+            until = time.time() + self.retry_after
+        LOGGER.info('HTTP/2 not available on %s (%s), using HTTP/1.1%s', key[0], error,
+            until is not None and ' for now' or '')
+        with self._lock:
+            self._fallback[key] = until
+        self._discard(key, conn)
+
+    def _discard(self, key, conn):
+        with self._lock:
+            if self._connections.get(key) is conn:
+                del self._connections[key]
+        conn.close()
+
+    def _open(self, req, secure):
+        key = (req.get_host(), secure)
+        conn = self._connection(key)
+        if conn is None:
+            return None
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers = dict((k.title(), v) for k, v in headers.items() if k.title() not in SKIP_HEADERS)
+
+        try:
+            stream_id = conn.request(req.get_method(), req.get_selector(),
+                body=req.data, headers=headers)
+            r = conn.get_response(stream_id)
+        except Exception as e:
+            with self._lock:
+                verified = key in self._verified
+            if not secure and not verified:
+                # An HTTP/1.1 server rejects the connection preface, the request was not run
+                self._fall_back(key, conn, e)
+                return None
+            if not isinstance(e, (socket.error, HTTP2ConnectionError)):
+                raise
+            self._discard(key, conn)
+            raise URLError(e)
+
+        with self._lock:
+            self._verified.add(key)
+
+        msg = httplib.HTTPMessage(StringIO(''.join(
+            '{0}: {1}\r\n'.format(k, v) for k, v in r.headers.items()
+        )))
+        resp = addinfourl(socket._fileobject(ResponseSocket(r), close=True), msg,
+            req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason or httplib.responses.get(r.status, '')
+        return resp
+
+    def http_open(self, req):
+        return self._open(req, False)
+
+    def https_open(self, req):
+        return self._open(req, True)
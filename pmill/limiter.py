@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import socket
+import threading
+import time
+from urllib2 import URLError
+
+__all__ = ('AdaptiveLimiter',)
+
+# Response codes telling the API is overloaded rather than the request is wrong
+OVERLOAD_CODES = frozenset((50000, 50500, 50501, 50502))
+
+
+def is_overload(error):
+    if isinstance(error, (URLError, socket.error)):
+        return True
+
+    code = getattr(error, 'code', None)
+    return code in OVERLOAD_CODES or (isinstance(code, int) and 500 <= code < 600)
+
+
+class AdaptiveLimiter(object):
+    """Limits concurrent requests, finding the highest sustainable limit (AIMD).
+
+    Every successful call adds ``1 / limit`` to the limit (one more slot per round of
+    requests). The limit is multiplied by ``backoff`` when a call fails because of overload
+    (5xx, timeouts, connection errors) or takes more than ``tolerance`` times the baseline
+    latency of its kind of call (and at least ``min_slow`` seconds). Only requests started
+    after the last decrease can decrease it again.
+
+    Calls are told apart by the ``key`` given to ``release()``, so that e.g. list pages are
+    not compared with single object reads.
+    """
+    def __init__(self, initial=4, min_limit=1, max_limit=256, backoff=0.5, tolerance=2.0,
+    min_slow=0.1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.min_slow = min_slow
+
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.baselines = {}
+
+        self._cond = threading.Condition()
+        self._last_drop = 0
+
+    def acquire(self):
+        """Waits for a free slot, returns the request start time to give to release()"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, start, error=None, key=None):
+        latency = time.time() - start
+
+        with self._cond:
+            self.in_flight -= 1
+
+            slow = False
+            if error is None:
+                baseline = self.baselines.get(key)
+                slow = (baseline is not None and latency >= self.min_slow
+                    and latency > baseline * self.tolerance)
+
+                if baseline is None or latency < baseline:
+                    self.baselines[key] = latency
+                else:
+                    # Slowly follow latency upwards so the baseline is not stuck forever
+                    self.baselines[key] = baseline + (latency - baseline) * 0.01
+
+            if slow or (error is not None and is_overload(error)):
+                if start >= self._last_drop:
+                    self._last_drop = time.time()
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+            elif error is None:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self._cond.notify_all()
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""Load generator for the Paymill client.
+
+Drives a weighted mix of operations against a base URL, or against a local stand-in server
+started for the run, and reports throughput, latency percentiles, errors and client
+resource usage::
+
+    python -m pmill.loadtest --concurrency 16 --rps 200 --duration 30 \\
+        --mix new_transaction=5,refund=1,get_transactions=2,new_subscription=1,export_clients=1
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict
+import json
+import random
+import resource
+from SocketServer import ThreadingMixIn
+import threading
+import time
+from urlparse import parse_qs, urlsplit
+
+from .api import DETAILED_ERRORS, ERRORS, Paymill, PaymillError
+
+__all__ = ('StandInServer', 'run')
+
+OPERATIONS = {
+    'new_transaction': lambda api, options: api.new_transaction(
+        amount=random.randint(100, 10000), token='tok_loadtest'
+    ),
+    'refund': lambda api, options: api.refund('tran_loadtest', 100),
+    'get_transactions': lambda api, options: [
+        x for x in api.iter_pages('transactions', count=options.count)
+    ],
+    'new_subscription': lambda api, options: api.new_subscription(
+        'client_loadtest', 'offer_loadtest', 'pay_loadtest'
+    ),
+    'export_clients': lambda api, options: api.export_clients(),
+}
+DEFAULT_MIX = 'new_transaction=5,refund=1,get_transactions=2,new_subscription=1,export_clients=1'
+
+
+def _fake(kind, index=0):
+    now = int(time.time())
+    ts = {'created_at': now, 'updated_at': now}
+    client = dict(ts, id='client_{0}'.format(index), email='client{0}@example.net'.format(index))
+    payment = dict(ts, id='pay_{0}'.format(index), type='creditcard', card_type='visa',
+        last4='1111', client=client['id'])
+
+    if kind == 'transactions':
+        return dict(ts, id='tran_{0}'.format(index), amount='3000', origin_amount=3000,
+            currency='EUR', status='closed', livemode=False, payment=payment, client=client,
+            refunds=None, preauthorization=None, response_code=20000)
+    if kind == 'refunds':
+        return dict(ts, id='refund_{0}'.format(index), transaction='tran_loadtest', amount=100,
+            status='refunded', livemode=False)
+    if kind == 'subscriptions':
+        offer = dict(ts, id='offer_loadtest', name='Load test', amount=1000,
+            interval='1 MONTH', trial_period_days=None)
+        return dict(ts, id='sub_{0}'.format(index), offer=offer, payment=payment, client=client,
+            livemode=False, cancel_at_period_end=False, next_capture_at=now + 86400)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers are written line by line, avoid delayed ACK stalls on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def _send(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self):
+        code = random.choice(self.server.error_codes)
+        if code in ERRORS:
+            return self._send(code, json.dumps({'error': ERRORS[code]}))
+        return self._send(403, json.dumps({'data': {'response_code': code}}))
+
+    def _handle(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        kind = len(parts) > 1 and parts[1] or ''
+
+        if self.server.latency:
+            time.sleep(random.expovariate(1 / self.server.latency))
+        if random.random() < self.server.error_rate:
+            return self._error()
+
+        if kind == 'clients' and 'csv' in (self.headers.getheader('Accept') or ''):
+            rows = ['"client_{0}";"client{0}@example.net"'.format(x) for x in range(500)]
+            return self._send(200, '\n'.join(['"id";"email"'] + rows), 'text/csv')
+
+        if kind in ('transactions', 'refunds', 'subscriptions'):
+            if self.command == 'GET':
+                query = parse_qs(url.query)
+                offset = int(query.get('offset', [0])[0])
+                count = int(query.get('count', [20])[0])
+                total = self.server.data_count
+                data = [_fake(kind, x) for x in range(offset, min(offset + count, total))]
+                return self._send(200, json.dumps({'data': data, 'data_count': total}))
+            return self._send(200, json.dumps({'data': _fake(kind)}))
+
+        self._send(404, json.dumps({'error': 'Not Found'}))
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the Paymill API, with injected errors and latency (in seconds)"""
+    daemon_threads = True
+
+    def __init__(self, port=0, error_rate=0.0, latency=0.0, data_count=250,
+    error_codes=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandInHandler)
+        self.error_rate = error_rate
+        self.latency = latency
+        self.data_count = data_count
+        self.error_codes = error_codes or sorted(ERRORS) + sorted(DETAILED_ERRORS)
+        self.base_url = 'http://127.0.0.1:{0}/v2/'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.1,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Pacer(object):
+    """Hands out request start times spaced for a target rate, until the deadline"""
+    def __init__(self, rps, deadline):
+        self.interval = rps and 1 / rps or 0
+        self.deadline = deadline
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            at = max(self._next, time.time())
+            self._next = at + self.interval
+
+        if at >= self.deadline:
+            return False
+        delay = at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, operation, latency, error=None):
+        with self._lock:
+            self.latencies[operation].append(latency)
+            if error is not None:
+                self.errors[(operation, error)] += 1
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in OPERATIONS:
+            raise ValueError('Unknown operation: {0}'.format(name))
+        weights.append((name.strip(), float(weight or 1)))
+    return weights
+
+
+def _choose(weights):
+    x = random.uniform(0, sum(w for _, w in weights))
+    for name, weight in weights:
+        x -= weight
+        if x <= 0:
+            return name
+    return weights[-1][0]
+
+
+def run(options):
+    """Runs a load test, returns the report as a dict"""
+    weights = parse_mix(options.mix)
+    server = None
+    base_url = options.base_url
+    if not base_url:
+        server = StandInServer(error_rate=options.error_rate, latency=options.latency).start()
+        base_url = server.base_url
+
+    api = Paymill(options.key, base_url=base_url,
+        max_connections=options.max_connections or options.concurrency)
+    stats = Stats()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    pacer = Pacer(options.rps, start + options.duration)
+
+    def worker():
+        while pacer.wait():
+            operation = _choose(weights)
+            t = time.time()
+            error = None
+            try:
+                OPERATIONS[operation](api, options)
+            except PaymillError as e:
+                error = e.code
+            except Exception as e:
+                error = type(e).__name__
+            stats.record(operation, time.time() - t, error)
+
+    try:
+        threads = [threading.Thread(target=worker) for x in range(options.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        elapsed = time.time() - start
+        api.close()
+        if server is not None:
+            server.stop()
+
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+    report = {
+        'duration': elapsed,
+        'requests': sum(len(x) for x in stats.latencies.values()),
+        'operations': {},
+        'errors': dict(('{0} {1}'.format(*k), v) for k, v in stats.errors.items()),
+        'cpu_seconds': cpu,
+        'cpu_percent': elapsed and cpu / elapsed * 100,
+        'max_rss_kb': end_usage.ru_maxrss,
+    }
+    report['throughput'] = elapsed and report['requests'] / elapsed
+
+    all_latencies = []
+    for operation, latencies in sorted(stats.latencies.items()):
+        all_latencies.extend(latencies)
+        report['operations'][operation] = dict(
+            [('count', len(latencies))]
+            + [('p{0}'.format(p), percentile(latencies, p)) for p in (50, 90, 99)]
+            + [('max', max(latencies))]
+        )
+    report['latency'] = dict(
+        ('p{0}'.format(p), percentile(all_latencies, p)) for p in (50, 90, 99)
+    )
+    return report
+
+
+def format_report(report):
+    lines = [
+        'Requests: {requests} in {duration:.1f}s ({throughput:.1f} req/s)'.format(**report),
+        'Client CPU: {cpu_seconds:.2f}s ({cpu_percent:.0f}%), max RSS: {max_rss_kb} kB'.format(
+            **report),
+        '',
+        '{0:<20} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9}'.format(
+            'operation', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'),
+    ]
+    for operation, x in sorted(report['operations'].items()):
+        lines.append('{0:<20} {1:>7} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f}'.format(
+            operation, x['count'], x['p50'] * 1000, x['p90'] * 1000, x['p99'] * 1000,
+            x['max'] * 1000))
+
+    if report['errors']:
+        lines.extend(['', 'Errors:'])
+        for k, v in sorted(report['errors'].items(), key=lambda x: -x[1]):
+            lines.append('  {0:<40} {1:>7}'.format(k, v))
+    return '\n'.join(lines)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='python -m pmill.loadtest', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', help='API URL, a local stand-in server is used if unset')
+    parser.add_argument('--key', default='loadtest-key', help='private key')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of worker threads')
+    parser.add_argument('--rps', type=float, default=0, help='target request rate, 0: unlimited')
+    parser.add_argument('--duration', type=float, default=10, help='duration in seconds')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weighted operations')
+    parser.add_argument('--count', type=int, default=100, help='page size of list calls')
+    parser.add_argument('--max-connections', type=int, help='default: concurrency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help='stand-in server: fraction of requests answered with an API error')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='stand-in server: mean response latency in seconds')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser
+
+
+def main(argv=None):
+    options = get_parser().parse_args(argv)
+    report = run(options)
+    if options.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from functools import partial
+import inspect
+import json
+from multiprocessing.pool import ThreadPool
+import sqlite3
+import threading
+import time
+
+from .api import PaymillError, PaymillObject
+from .limiter import is_overload
+
+__all__ = ('Outbox',)
+
+# Paymill methods which can be deferred
+UPDATES = ('update_client', 'update_offer', 'update_subscription', 'update_transaction',
+    'update_webhook')
+# Parameters of an update which exclude each other: setting one drops the others when merging
+EXCLUSIVE = {
+    'update_webhook': ('url', 'email'),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    method TEXT NOT NULL,
+    object_id TEXT NOT NULL,
+    params TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    due REAL NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS outbox_pending ON outbox (method, object_id)
+    WHERE state = 'pending';
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, due);
+"""
+
+
+class Outbox(object):
+    """Write-behind queue for updates which do not need to block the caller.
+
+    Updates are stored in a SQLite database at ``path`` and return once committed. Pending
+    updates of the same object are merged, later values winning, so only the last write of
+    each field is sent. ``start()`` runs a dispatcher thread sending due updates with
+    ``workers`` threads, one at a time per object. Overload and network errors are retried
+    with exponential backoff up to ``max_attempts`` times; other errors are kept as failed.
+
+    Paymill update methods are available on the outbox itself::
+
+        outbox.update_client('client_1', email='new@example.com')
+    """
+    def __init__(self, api, path, workers=4, batch_size=100, max_attempts=8, retry_delay=1,
+    poll=5):
+        self.api = api
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll = poll
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(workers)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._args = dict(
+            (x, inspect.getargspec(getattr(api, x)).args[2:]) for x in UPDATES
+        )
+
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+            # Updates interrupted while being sent are sent again
+            for row in self._db.execute(
+                "SELECT id, method, object_id, params FROM outbox WHERE state = 'sending'"
+            ).fetchall():
+                self._db.execute('DELETE FROM outbox WHERE id = ?', (row[0],))
+                self._merge(row[1], row[2], json.loads(row[3]), newer=False)
+
+    def __getattr__(self, name):
+        if name in UPDATES:
+            return partial(self.enqueue, name)
+        raise AttributeError(name)
+
+    def _merge(self, method, object_id, params, newer=True):
+        pending = self._db.execute(
+            "SELECT id, params FROM outbox WHERE method = ? AND object_id = ?"
+            " AND state = 'pending'", (method, object_id)
+        ).fetchone()
+        if pending is None:
+            self._db.execute('INSERT INTO outbox (method, object_id, params) VALUES (?, ?, ?)',
+                (method, object_id, json.dumps(params)))
+            return
+
+        old, new = json.loads(pending[1]), params
+        if not newer:
+            old, new = new, old
+        exclusive = EXCLUSIVE.get(method, ())
+        merged = dict((k, v) for k, v in old.items()
+            if k not in exclusive or not any(x in new for x in exclusive))
+        merged.update(new)
+        self._db.execute('UPDATE outbox SET params = ? WHERE id = ?',
+            (json.dumps(merged), pending[0]))
+
+    def enqueue(self, method, object_id, *args, **kwargs):
+        """Stores a call to the Paymill update ``method``, arguments set to None are left out.
+        Returns False when nothing is left to send."""
+        if method not in UPDATES:
+            raise ValueError('Unsupported update: {0}'.format(method))
+        kwargs.update(zip(self._args[method], args))
+        # Objects are stored by ID
+        params = dict((k, isinstance(v, PaymillObject) and v.id or v) for k, v in kwargs.items()
+            if v is not None)
+        if not params:
+            return False
+
+        with self._lock, self._db:
+            self._merge(method, getattr(object_id, 'id', object_id), params)
+        self._wakeup.set()
+        return True
+
+    def pending(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM outbox WHERE state IN ('pending', 'sending')"
+            ).fetchone()[0]
+
+    def failed(self):
+        """Returns failed updates as (method, object ID, params, error) tuples"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT method, object_id, params, error FROM outbox WHERE state = 'failed'"
+                ' ORDER BY id'
+            ).fetchall()
+        return [(x[0], x[1], json.loads(x[2]), x[3]) for x in rows]
+
+    def _send(self, row):
+        entry_id, method, object_id, params = row
+        try:
+            getattr(self.api, method)(object_id, **json.loads(params))
+            return entry_id, None
+        except Exception as e:
+            return entry_id, e
+
+    def _finish(self, entry_id, error):
+        with self._lock, self._db:
+            if error is None:
+                self._db.execute('DELETE FROM outbox WHERE id = ?', (entry_id,))
+                return
+
+            attempts = self._db.execute('SELECT attempts FROM outbox WHERE id = ?',
+                (entry_id,)).fetchone()[0] + 1
+            message = isinstance(error, PaymillError) and '{0} {1}'.format(
+                error.code, error.args[-1]) or repr(error)
+
+            if not is_overload(error) or attempts >= self.max_attempts:
+                self._db.execute(
+                    "UPDATE outbox SET state = 'failed', attempts = ?, error = ? WHERE id = ?",
+                    (attempts, message, entry_id)
+                )
+                return
+
+            # A newer pending update of the object takes the place of this one
+            row = self._db.execute('SELECT method, object_id, params FROM outbox WHERE id = ?',
+                (entry_id,)).fetchone()
+            self._db.execute('DELETE FROM outbox WHERE id = ?', (entry_id,))
+            self._merge(row[0], row[1], json.loads(row[2]), newer=False)
+            self._db.execute('UPDATE outbox SET attempts = ?, error = ?, due = ?'
+                " WHERE method = ? AND object_id = ? AND state = 'pending'",
+                (attempts, message, time.time() + self.retry_delay * 2 ** (attempts - 1),
+                    row[0], row[1]))
+
+    def dispatch(self, now=None):
+        """Sends every due update, returns the number of updates sent or failed"""
+        now = time.time() if now is None else now
+        processed = 0
+        while True:
+            with self._lock, self._db:
+                rows = self._db.execute(
+                    'SELECT id, method, object_id, params FROM outbox o'
+                    " WHERE state = 'pending' AND due <= ? AND NOT EXISTS ("
+                    "   SELECT 1 FROM outbox s WHERE s.state = 'sending'"
+                    '   AND s.method = o.method AND s.object_id = o.object_id'
+                    ') ORDER BY id LIMIT ?', (now, self.batch_size)
+                ).fetchall()
+                self._db.executemany("UPDATE outbox SET state = 'sending' WHERE id = ?",
+                    [(x[0],) for x in rows])
+            if not rows:
+                return processed
+
+            for entry_id, error in self._pool.imap_unordered(self._send, rows):
+                self._finish(entry_id, error)
+            processed += len(rows)
+
+    def next_due(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT MIN(due) FROM outbox WHERE state = 'pending'").fetchone()[0]
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            self.dispatch()
+            next_due = self.next_due()
+            self._wakeup.wait(
+                self.poll if next_due is None else min(self.poll, max(0, next_due - time.time()))
+            )
+
+    def start(self):
+        """Starts sending updates in a background thread"""
+        self._thread = threading.Thread(target=self._run, name='pmill-outbox')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def flush(self, timeout=None):
+        """Waits until no update is due, returns False on timeout. Without a dispatcher thread,
+        due updates are sent by the calling thread."""
+        if self._thread is None:
+            self.dispatch()
+            return True
+
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            with self._lock:
+                due = self._db.execute(
+                    "SELECT COUNT(*) FROM outbox WHERE state = 'sending'"
+                    " OR (state = 'pending' AND due <= ?)", (time.time(),)
+                ).fetchone()[0]
+            if not due:
+                return True
+            if deadline and time.time() >= deadline:
+                return False
+            self._wakeup.set()
+            time.sleep(0.01)
+
+    def close(self):
+        """Stops the dispatcher, pending updates are sent on the next start"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._pool.close()
+        self._pool.join()
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import threading
+
+from .api import BASE_URL, IdentityMap, Paymill, PaymillList
+from .connection import ConnectionBudget
+
+__all__ = ('PaymillPool',)
+
+
+class PaymillPool(object):
+    """Registry of long-lived clients for many merchant accounts.
+
+    Clients are created on first use and keep their own persistent connections and metrics.
+    The total number of open connections is bounded by ``max_connections``: when it is
+    reached, idle connections of the least recently used accounts are closed and clients left
+    without connections are dropped (they are created again on demand).
+    """
+    def __init__(self, max_connections=32, connections_per_account=4, workers=8,
+    base_url=BASE_URL, client_class=Paymill, tracer=None):
+        self.max_connections = max_connections
+        self.connections_per_account = min(connections_per_account, max_connections)
+        self.workers = workers
+        self.base_url = base_url
+        self.client_class = client_class
+        self.tracer = tracer
+
+        self._keys = OrderedDict()
+        self._clients = OrderedDict()
+        self._lock = threading.RLock()
+        self._pool = None
+        self._budget = ConnectionBudget(max_connections, self._reclaim)
+
+    def register(self, account, private_key):
+        with self._lock:
+            if self._keys.get(account) != private_key:
+                self._discard(account)
+            self._keys[account] = private_key
+
+    def unregister(self, account):
+        with self._lock:
+            self._discard(account)
+            del self._keys[account]
+
+    @property
+    def accounts(self):
+        return list(self._keys)
+
+    @property
+    def open_connections(self):
+        return self._budget.open_connections
+
+    def get(self, account):
+        with self._lock:
+            client = self._clients.pop(account, None)
+            if client is None:
+                client = self.client_class(self._keys[account],
+                    base_url=self.base_url,
+                    max_connections=self.connections_per_account,
+                    tracer=self.tracer
+                )
+                client.connections.budget = self._budget
+            self._clients[account] = client
+            return client
+
+    __getitem__ = get
+
+    def metrics(self):
+        with self._lock:
+            return OrderedDict((k, c.metrics.as_dict()) for k, c in self._clients.items())
+
+    def _discard(self, account):
+        client = self._clients.pop(account, None)
+        if client is not None:
+            # Connections still in use are closed when released
+            client.connections.reuse = False
+            client.close()
+
+    def _reclaim(self):
+        with self._lock:
+            for account, client in list(self._clients.items()):
+                if client.connections.idle_connections:
+                    client.close()
+                    if not client.connections.open_connections:
+                        # Callers may still hold the client: its later connections are
+                        # closed after use, they are out of reach of reclaim
+                        client.connections.reuse = False
+                        del self._clients[account]
+                    return True
+        return False
+
+    def fan_out(self, method, *args, **kwargs):
+        """Calls ``method`` on every account in parallel, returns results by account"""
+        accounts = self.accounts
+
+        @IdentityMap.wrap
+        def call(account):
+            return getattr(self.get(account), method)(*args, **kwargs)
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+
+        if self.tracer is None:
+            return OrderedDict(zip(accounts, self._pool.map(call, accounts)))
+
+        # Calls of all accounts are children of one span
+        with self.tracer.span('pmill.fan_out', {'paymill.method': method,
+        'paymill.accounts': len(accounts)}) as span:
+            return OrderedDict(zip(accounts, self._pool.map(self.tracer.wrap(call, span),
+                accounts)))
+
+    def merge(self, method, *args, **kwargs):
+        """Same as fan_out, with list results merged in a single PaymillList"""
+        results = self.fan_out(method, *args, **kwargs).values()
+        return PaymillList(
+            sum(x.data_count for x in results),
+            [x for result in results for x in result]
+        )
+
+    def close(self):
+        with self._lock:
+            for account in list(self._clients):
+                self._discard(account)
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import sqlite3
+import threading
+import time
+
+from .api import PaymillError, Preauthorization, Transaction
+from .limiter import is_overload
+
+__all__ = ('CAPTURE', 'RELEASE', 'PreauthScheduler')
+
+CAPTURE = 'capture'
+RELEASE = 'release'
+
+# Statuses of preauthorizations which can still be captured or released
+OPEN_STATUSES = frozenset(('open', 'preauth'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS preauths (
+    id TEXT PRIMARY KEY,
+    due INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    amount INTEGER,
+    currency TEXT,
+    description TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS preauths_due ON preauths (state, due);
+"""
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        # Objects hold local times, see PaymillObject
+        return int(time.mktime(value.timetuple()))
+    return int(value)
+
+
+class PreauthScheduler(object):
+    """Captures or releases preauthorizations when they are due.
+
+    Entries are stored in a SQLite database at ``path`` and indexed by due time, so each run
+    only reads the due entries (``batch_size`` at a time) however many are pending, and the
+    schedule survives restarts. Due entries are processed by ``workers`` threads; failures
+    caused by overload or network errors are retried with exponential backoff, up to
+    ``max_attempts`` times, other errors are final.
+
+    Entries interrupted while running (e.g. by a crash) are due again on restart; the API
+    refuses to capture or release a preauthorization twice.
+    """
+    def __init__(self, api, path, workers=8, batch_size=100, max_attempts=5, retry_delay=60):
+        self.api = api
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(workers)
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+            self._db.execute("UPDATE preauths SET state = 'pending' WHERE state = 'running'")
+
+    def schedule(self, preauth, due, action=CAPTURE, amount=None, currency=None,
+    description=None):
+        """Schedules ``action`` for ``preauth`` (object, transaction returned by
+        ``Paymill.preauthorize`` or ID) at ``due`` (timestamp or datetime), replacing a
+        previous schedule. The whole preauthorized amount is captured by default.
+        """
+        if isinstance(preauth, Transaction):
+            preauth = preauth.preauthorization
+        if isinstance(preauth, Preauthorization):
+            amount = amount or preauth.amount
+            currency = currency or getattr(preauth, 'currency', None)
+            preauth = preauth.id
+        if action == CAPTURE and not amount:
+            raise ValueError('The amount to capture is required')
+
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO preauths (id, due, action, amount, currency, description)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (preauth, _timestamp(due), action, amount, currency or 'EUR', description)
+            )
+
+    def track(self, preauths, delay, action=CAPTURE):
+        """Schedules ``action`` ``delay`` seconds after creation for the open preauthorizations
+        of ``preauths`` (e.g. pages of ``Paymill.iter_pages('preauthorizations')``) which are
+        not scheduled yet. Returns the number of new entries.
+        """
+        rows = []
+        for page in preauths:
+            for x in isinstance(page, Preauthorization) and [page] or page:
+                if x.status in OPEN_STATUSES:
+                    rows.append((x.id, _timestamp(x.created_at) + delay, action, x.amount,
+                        getattr(x, 'currency', None) or 'EUR'))
+
+        with self._lock, self._db:
+            before = self._db.total_changes
+            self._db.executemany(
+                'INSERT OR IGNORE INTO preauths (id, due, action, amount, currency)'
+                ' VALUES (?, ?, ?, ?, ?)', rows
+            )
+            return self._db.total_changes - before
+
+    def cancel(self, preauth_id):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM preauths WHERE id = ? AND state = 'pending'",
+                (preauth_id,))
+
+    def get(self, preauth_id):
+        """Returns the entry of a preauthorization as a dict, or None"""
+        with self._lock:
+            cursor = self._db.execute('SELECT * FROM preauths WHERE id = ?', (preauth_id,))
+            row = cursor.fetchone()
+        return row and dict(zip([x[0] for x in cursor.description], row))
+
+    def pending(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM preauths WHERE state = 'pending'").fetchone()[0]
+
+    def next_due(self):
+        """Due time of the next pending entry, or None"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT MIN(due) FROM preauths WHERE state = 'pending'").fetchone()[0]
+
+    def _process(self, row):
+        preauth_id, action, amount, currency, description = row
+        try:
+            if action == CAPTURE:
+                result = self.api.new_transaction(amount, currency, description,
+                    preauth=preauth_id)
+            else:
+                result = self.api.delete_preauthorization(preauth_id)
+            return preauth_id, result and result.id, None
+        except Exception as e:
+            return preauth_id, None, e
+
+    def run_due(self, now=None):
+        """Processes every entry due at ``now``, returns the number of processed entries"""
+        now = time.time() if now is None else now
+        processed = 0
+        while True:
+            with self._lock, self._db:
+                rows = self._db.execute(
+                    'SELECT id, action, amount, currency, description FROM preauths'
+                    " WHERE state = 'pending' AND due <= ? ORDER BY due LIMIT ?",
+                    (now, self.batch_size)
+                ).fetchall()
+                self._db.executemany("UPDATE preauths SET state = 'running' WHERE id = ?",
+                    [(x[0],) for x in rows])
+            if not rows:
+                return processed
+
+            for preauth_id, result, error in self._pool.imap_unordered(self._process, rows):
+                self._finish(preauth_id, result, error)
+            processed += len(rows)
+
+    def _finish(self, preauth_id, result, error):
+        with self._lock, self._db:
+            if error is None:
+                self._db.execute("UPDATE preauths SET state = 'done', result = ? WHERE id = ?",
+                    (result, preauth_id))
+                return
+
+            attempts = self._db.execute('SELECT attempts FROM preauths WHERE id = ?',
+                (preauth_id,)).fetchone()[0] + 1
+            message = isinstance(error, PaymillError) and '{0} {1}'.format(
+                error.code, error.args[-1]) or repr(error)
+
+            if is_overload(error) and attempts < self.max_attempts:
+                self._db.execute(
+                    "UPDATE preauths SET state = 'pending', attempts = ?, result = ?,"
+                    ' due = ? WHERE id = ?',
+                    (attempts, message, int(time.time() + self.retry_delay * 2 ** (attempts - 1)),
+                        preauth_id)
+                )
+            else:
+                self._db.execute(
+                    "UPDATE preauths SET state = 'failed', attempts = ?, result = ?"
+                    ' WHERE id = ?', (attempts, message, preauth_id)
+                )
+
+    def run(self, stop, poll=60):
+        """Processes due entries until the ``stop`` event is set, waking up when the next
+        entry is due or every ``poll`` seconds (to pick up entries added meanwhile)."""
+        while not stop.is_set():
+            self.run_due()
+            next_due = self.next_due()
+            timeout = poll if next_due is None else min(poll, max(0, next_due - time.time()))
+            stop.wait(timeout)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        with self._lock:
+            self._db.close()
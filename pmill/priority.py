@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from contextlib import contextmanager
+from functools import wraps
+import threading
+
+__all__ = ('BACKGROUND', 'INTERACTIVE', 'PriorityScheduler')
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+
+class PriorityScheduler(object):
+    """Shares ``max_concurrency`` request slots between interactive and background calls.
+
+    Background calls use at most ``background`` slots and never start while interactive calls
+    are waiting. Each call (each page of a list) takes its own slot, so bulk work yields to
+    interactive work between pages.
+
+    List calls (GET on a collection, CSV exports) default to the background lane, everything
+    else to the interactive lane. Use ``with scheduler.lane(...)`` to override it for the
+    calls made by the current thread, and ``wrap()`` to keep it in calls made for it by other
+    threads.
+    """
+    def __init__(self, max_concurrency=8, background=2):
+        self.max_concurrency = max_concurrency
+        self.limits = {INTERACTIVE: max_concurrency, BACKGROUND: min(background, max_concurrency)}
+        self.running = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    @contextmanager
+    def lane(self, name):
+        previous = getattr(self._local, 'lane', None)
+        self._local.lane = name
+        try:
+            yield
+        finally:
+            self._local.lane = previous
+
+    def wrap(self, func):
+        """Returns ``func`` running in the lane of the current thread, e.g. in a thread pool"""
+        lane = getattr(self._local, 'lane', None)
+        if lane is None:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.lane(lane):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def classify(self, method, endpoint):
+        lane = getattr(self._local, 'lane', None)
+        if lane is not None:
+            return lane
+        if method == 'GET' and endpoint.endswith('/'):
+            return BACKGROUND
+        return INTERACTIVE
+
+    def _can_run(self, lane):
+        if sum(self.running.values()) >= self.max_concurrency:
+            return False
+        if self.running[lane] >= self.limits[lane]:
+            return False
+        return lane == INTERACTIVE or not self.waiting[INTERACTIVE]
+
+    def acquire(self, lane):
+        with self._cond:
+            self.waiting[lane] += 1
+            try:
+                while not self._can_run(lane):
+                    self._cond.wait()
+            finally:
+                self.waiting[lane] -= 1
+            self.running[lane] += 1
+        return lane
+
+    def release(self, lane):
+        with self._cond:
+            self.running[lane] -= 1
+            self._cond.notify_all()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from collections import Counter
+import io
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ('Profiler',)
+
+# Call stages, by span name (see Paymill._span)
+STAGES = {
+    'pmill.prepare': 'build',
+    'pmill.http': 'network',
+    'pmill.decode': 'decode',
+    'pmill.build': 'construct',
+}
+# Parameters whose values are left out of the slow-call log
+SENSITIVE = ('token', 'email', 'description', 'name', 'url')
+
+
+def _sanitize(params):
+    if not isinstance(params, dict):
+        return params
+    return dict(
+        (k, any(x in k for x in SENSITIVE) and '***' or v) for k, v in params.items()
+    )
+
+
+def _max_rss():
+    return resource is not None and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss or 0
+
+
+class _Stage(object):
+    """Times a stage of a sampled call around its span"""
+    def __init__(self, record, name, span):
+        self.record = record
+        self.name = name
+        self.span = span
+
+    def __enter__(self):
+        self.start = time.time()
+        return self.span.__enter__()
+
+    def __exit__(self, *args):
+        self.record[self.name] += time.time() - self.start
+        return self.span.__exit__(*args)
+
+
+class Profiler(object):
+    """Profiles a fraction of the calls of a client, e.g.
+    ``Paymill(key, profiler=Profiler(sample_rate=0.05))``.
+
+    The stacks of the threads running sampled calls are sampled every ``interval`` seconds,
+    see ``collapsed()``. Sampled calls also add up their wall time by stage (request build,
+    network exchange with the body read, JSON decoding, object construction), the CPU time
+    and the peak RSS growth of the process. Calls slower than ``slow_threshold`` seconds,
+    sampled or not, are logged as JSON with sensitive parameters masked, to a rotating file
+    at ``log_path`` or to the "pmill.slow_calls" logger.
+    """
+    def __init__(self, sample_rate=0.01, interval=0.005, slow_threshold=1.0, log_path=None,
+    max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+
+        self.calls = 0
+        self.sampled = 0
+        self.slow = 0
+        self.breakdown = Counter()
+        self.stacks = Counter()
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._active = set()
+        self._sampling = threading.Event()
+        self._stop = None
+        self._thread = None
+
+        self._handler = None
+        if log_path is None:
+            self.log = logging.getLogger('pmill.slow_calls')
+        else:
+            self.log = logging.Logger('pmill.slow_calls')
+            self._handler = RotatingFileHandler(log_path, maxBytes=max_bytes,
+                backupCount=backup_count)
+            self._handler.setFormatter(logging.Formatter('%(message)s'))
+            self.log.addHandler(self._handler)
+
+    def stage(self, name, span):
+        """Returns ``span``, timed when it is a stage of a sampled call"""
+        record = getattr(self._local, 'record', None)
+        if record is None or name not in STAGES:
+            return span
+        return _Stage(record, STAGES[name], span)
+
+    def _sample(self, stop):
+        code = Profiler.call.__func__.__code__
+        while not stop.is_set():
+            self._sampling.wait()
+            if stop.is_set():
+                break
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident in self._active:
+                    frame = frames.get(ident)
+                    stack = []
+                    # Stacks start at the profiled call
+                    while frame is not None:
+                        stack.append('{0}:{1}'.format(frame.f_globals.get('__name__'),
+                            frame.f_code.co_name))
+                        if frame.f_code is code:
+                            break
+                        frame = frame.f_back
+                    if stack:
+                        self.stacks[';'.join(reversed(stack))] += 1
+
+    def _start(self, record):
+        self._local.record = record
+        with self._lock:
+            self._active.add(threading.current_thread().ident)
+            self._sampling.set()
+            if self._thread is None:
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._sample, args=(self._stop,),
+                    name='pmill-profiler')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _finish(self, record):
+        self._local.record = None
+        with self._lock:
+            self._active.discard(threading.current_thread().ident)
+            if not self._active:
+                self._sampling.clear()
+            self.sampled += 1
+            self.breakdown.update(record)
+
+    def call(self, func, endpoint, params=None, method='GET', *args):
+        """Runs ``func(endpoint, params, method, *args)``, profiled if sampled"""
+        record = None
+        if random.random() < self.sample_rate:
+            record = Counter()
+            cpu = sum(os.times()[:2])
+            rss = _max_rss()
+            self._start(record)
+
+        error = None
+        start = time.time()
+        try:
+            return func(endpoint, params, method, *args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            duration = time.time() - start
+            if record is not None:
+                record['total'] = duration
+                record['cpu'] = sum(os.times()[:2]) - cpu
+                record['rss_kb'] = _max_rss() - rss
+                self._finish(record)
+
+            with self._lock:
+                self.calls += 1
+                if duration >= self.slow_threshold:
+                    self.slow += 1
+            if duration >= self.slow_threshold:
+                self.log.warning(json.dumps({
+                    'time': start,
+                    'method': method,
+                    'endpoint': endpoint.partition('?')[0],
+                    'params': _sanitize(params),
+                    'duration': round(duration, 6),
+                    'error': error is not None and (getattr(error, 'code', None)
+                        or type(error).__name__) or None,
+                    'stages': record is not None and dict(record) or None,
+                }, default=repr, sort_keys=True))
+
+    def collapsed(self):
+        """Sampled stacks in the collapsed format of flamegraph.pl, one "stack count" line
+        per stack"""
+        with self._lock:
+            return ['{0} {1}'.format(k, v) for k, v in sorted(self.stacks.items())]
+
+    def write_collapsed(self, path):
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for line in self.collapsed():
+                f.write('{0}\n'.format(line))
+
+    def reset(self):
+        with self._lock:
+            self.calls = self.sampled = self.slow = 0
+            self.breakdown.clear()
+            self.stacks.clear()
+
+    def close(self):
+        """Stops the sampler thread, it is started again by the next sampled call"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stop.set()
+                self._sampling.set()
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            if not self._active:
+                self._sampling.clear()
+        if self._handler is not None:
+            self._handler.close()
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""Subscription capture schedule and revenue projection (requires numpy).
+
+Subscriptions are loaded once into column arrays, all future captures in a time range are then
+computed and aggregated without a Python loop per subscription or per capture::
+
+    subscriptions = SubscriptionArrays.from_subscriptions(api.iter_pages('subscriptions'))
+    projection = subscriptions.project(start, end)
+    for day, currency, offer, captures, amount in projection.revenue().rows():
+        ...
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from datetime import datetime
+import time
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+from .api import RE_INTERVAL, PaymillList
+
+__all__ = ('HAS_NUMPY', 'Projection', 'Revenue', 'SubscriptionArrays', 'parse_interval')
+
+DAY = 86400
+UNITS = ('DAY', 'WEEK', 'MONTH', 'YEAR')
+# Length of each unit, in seconds for DAY and WEEK, in months for MONTH and YEAR
+UNIT_SIZES = (DAY, 7 * DAY, 1, 12)
+NEVER = 2 ** 62
+
+
+def parse_interval(interval):
+    """Parses an offer interval, "2 WEEK" gives (2, "WEEK")"""
+    match = RE_INTERVAL.search((interval or '').strip())
+    if match is None:
+        raise ValueError('Invalid interval: {0!r}'.format(interval))
+    return int(match.string[:match.start(1)].strip() or 1), match.group(1).upper()
+
+
+def _get(obj, name):
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        # Objects hold local times, see PaymillObject
+        return int(time.mktime(value.timetuple()))
+    return value
+
+
+def _month_start(months):
+    """Unix timestamps of the first second of months given as months since 1970-01"""
+    return months.astype('datetime64[M]').astype('datetime64[s]').astype(np.int64)
+
+
+def _expand(first_k, counts):
+    """Returns (row, k) pairs for k in first_k[row] .. first_k[row] + counts[row] - 1"""
+    rows = np.repeat(np.arange(len(counts)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, k + first_k[rows]
+
+
+class SubscriptionArrays(object):
+    """Columns of the fields of subscriptions (and their offers) used for projections.
+
+    ``currencies`` and ``offers`` hold the values indexed by the ``currency`` and ``offer``
+    columns. Times are unix timestamps; ``end`` is the time from which a subscription is not
+    captured anymore. ``skipped`` lists (ID, reason) pairs of the subscriptions left out.
+    """
+    def __init__(self, first, count, unit, amount, currency, offer, end, ids, currencies,
+    offers, skipped=()):
+        self.first = first
+        self.count = count
+        self.unit = unit
+        self.amount = amount
+        self.currency = currency
+        self.offer = offer
+        self.end = end
+        self.ids = ids
+        self.currencies = currencies
+        self.offers = offers
+        self.skipped = list(skipped)
+
+    def __len__(self):
+        return len(self.first)
+
+    @classmethod
+    def from_subscriptions(cls, subscriptions, offers=None, currency='EUR'):
+        """Builds the columns from Subscription objects or raw API dicts.
+
+        Iterables of pages (as returned by ``Paymill.iter_pages``) are accepted. Offers given
+        as bare IDs are looked up in ``offers`` (a dict of Offer objects or dicts by ID),
+        ``currency`` is used for offers without one. Subscriptions without offer, with an
+        unknown offer ID or an invalid interval are skipped.
+        """
+        if not HAS_NUMPY:
+            raise ImportError('Projections require numpy')
+
+        offers = dict(offers or {})
+        intervals = {}
+        skipped = []
+        codes = {'currency': {}, 'offer': {}}
+        columns = [[] for x in range(8)]
+
+        def code(kind, value):
+            return codes[kind].setdefault(value, len(codes[kind]))
+
+        def rows():
+            for x in subscriptions:
+                if isinstance(x, PaymillList):
+                    for y in x:
+                        yield y
+                else:
+                    yield x
+
+        for sub in rows():
+            offer = _get(sub, 'offer')
+            if isinstance(offer, basestring):
+                if offer not in offers:
+                    skipped.append((_get(sub, 'id'), 'Unknown offer: {0}'.format(offer)))
+                    continue
+                offer = offers[offer]
+            if not offer:
+                skipped.append((_get(sub, 'id'), 'No offer'))
+                continue
+            offer_id = _get(offer, 'id')
+
+            if offer_id not in intervals:
+                try:
+                    intervals[offer_id] = parse_interval(_get(offer, 'interval'))
+                except ValueError as e:
+                    intervals[offer_id] = e.args[0]
+            if not isinstance(intervals[offer_id], tuple):
+                skipped.append((_get(sub, 'id'), intervals[offer_id]))
+                continue
+            count, unit = intervals[offer_id]
+
+            first = _get(sub, 'next_capture_at') or _get(sub, 'trial_end')
+            if not first:
+                first = _timestamp(_get(sub, 'created_at')) + \
+                    (_get(offer, 'trial_period_days') or 0) * DAY
+
+            end = NEVER
+            if _get(sub, 'canceled_at'):
+                end = _get(sub, 'canceled_at')
+            elif _get(sub, 'cancel_at_period_end'):
+                end = first
+
+            for column, value in zip(columns, (
+                first, count, UNITS.index(unit), int(_get(offer, 'amount') or 0),
+                code('currency', _get(offer, 'currency') or currency), code('offer', offer_id),
+                end, _get(sub, 'id'),
+            )):
+                column.append(value)
+
+        def names(kind):
+            return [k for k, v in sorted(codes[kind].items(), key=lambda x: x[1])]
+
+        return cls(
+            np.array(columns[0], dtype=np.int64), np.array(columns[1], dtype=np.int64),
+            np.array(columns[2], dtype=np.int8), np.array(columns[3], dtype=np.int64),
+            np.array(columns[4], dtype=np.int32), np.array(columns[5], dtype=np.int32),
+            np.array(columns[6], dtype=np.int64), columns[7],
+            names('currency'), names('offer'), skipped,
+        )
+
+    def project(self, start, end):
+        """Computes every capture from ``start`` (included) to ``end`` (excluded)"""
+        limit = np.minimum(self.end, end)
+        size = np.take(np.array(UNIT_SIZES, dtype=np.int64), self.unit) * self.count
+        rows, times = [], []
+
+        # DAY and WEEK intervals have a fixed length
+        fixed = np.nonzero((self.unit <= 1) & (limit > self.first))[0]
+        first, step = self.first[fixed], size[fixed]
+        first_k = np.maximum(0, -(-(start - first) // step))
+        counts = np.maximum(0, -(-(limit[fixed] - first) // step) - first_k)
+        r, k = _expand(first_k, counts)
+        rows.append(fixed[r])
+        times.append(first[r] + k * step[r])
+
+        # MONTH and YEAR captures fall on the same day of month (or the last one of shorter
+        # months), ranges are bounded in months then trimmed
+        calendar_rows = np.nonzero((self.unit >= 2) & (limit > self.first))[0]
+        first, step = self.first[calendar_rows], size[calendar_rows]
+        base = first.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+        offset = first - _month_start(base)
+        start_month = np.datetime64(int(start), 's').astype('datetime64[M]').astype(np.int64)
+        end_month = (limit[calendar_rows].astype('datetime64[s]')
+            .astype('datetime64[M]').astype(np.int64))
+        first_k = np.maximum(0, (start_month - base) // step - 1)
+        counts = np.maximum(0, (end_month - base) // step - first_k + 1)
+        r, k = _expand(first_k, counts)
+
+        month = base[r] + k * step[r]
+        month_start = _month_start(month)
+        last_day = (_month_start(month + 1) - month_start) // DAY - 1
+        day = np.minimum(offset[r] // DAY, last_day)
+        t = month_start + day * DAY + offset[r] % DAY
+        keep = (t >= start) & (t < limit[calendar_rows][r])
+        rows.append(calendar_rows[r][keep])
+        times.append(t[keep])
+
+        return Projection(self, np.concatenate(rows), np.concatenate(times))
+
+
+class Projection(object):
+    """Captures: ``rows`` (index of the subscription) captured at ``times``, unordered"""
+    def __init__(self, subscriptions, rows, times):
+        self.subscriptions = subscriptions
+        self.rows = rows
+        self.times = times
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def amounts(self):
+        return self.subscriptions.amount[self.rows]
+
+    def schedule(self):
+        """Yields (unix timestamp, subscription ID, amount) for every capture, by time"""
+        ids = self.subscriptions.ids
+        order = np.argsort(self.times, kind='mergesort')
+        for row, t, amount in zip(self.rows[order].tolist(), self.times[order].tolist(),
+        self.amounts[order].tolist()):
+            yield t, ids[row], amount
+
+    def revenue(self):
+        """Expected revenue per UTC day, currency and offer"""
+        subs = self.subscriptions
+        days = self.times // DAY
+        first_day = days.min() if len(days) else 0
+        n_currencies, n_offers = max(1, len(subs.currencies)), max(1, len(subs.offers))
+
+        key = ((days - first_day) * n_currencies + subs.currency[self.rows]) * n_offers + \
+            subs.offer[self.rows]
+        span = int(key.max()) + 1 if len(key) else 0
+
+        # Counting over the whole key range avoids sorting the captures, unless it is sparse
+        if span <= max(len(key), 1 << 20):
+            captures = np.bincount(key, minlength=span)
+            amounts = np.bincount(key, weights=self.amounts, minlength=span)
+            keys = np.nonzero(captures)[0]
+            captures, amounts = captures[keys], amounts[keys]
+        else:
+            keys, groups = np.unique(key, return_inverse=True)
+            captures = np.bincount(groups, minlength=len(keys))
+            amounts = np.bincount(groups, weights=self.amounts, minlength=len(keys))
+
+        return Revenue(
+            (keys // (n_currencies * n_offers) + first_day).astype('datetime64[D]'),
+            np.take(np.array(subs.currencies or [''], dtype=object),
+                keys // n_offers % n_currencies),
+            np.take(np.array(subs.offers or [''], dtype=object), keys % n_offers),
+            captures, amounts.astype(np.int64),
+        )
+
+
+class Revenue(object):
+    """Aggregated captures: one row per (day, currency, offer), sorted"""
+    def __init__(self, day, currency, offer, captures, amount):
+        self.day = day
+        self.currency = currency
+        self.offer = offer
+        self.captures = captures
+        self.amount = amount
+
+    def __len__(self):
+        return len(self.day)
+
+    def rows(self):
+        """Yields (date, currency, offer ID, number of captures, amount) tuples"""
+        return zip(self.day.tolist(), self.currency.tolist(), self.offer.tolist(),
+            self.captures.tolist(), self.amount.tolist())
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from datetime import date
+from itertools import islice
+import operator
+import time
+
+__all__ = ('Query',)
+
+# Filters and sort fields supported by each list endpoint
+FILTERS = {
+    'clients': ('email', 'payment', 'subscription', 'offer', 'description', 'created_at',
+        'updated_at'),
+    'offers': ('name', 'trial_period_days', 'amount', 'created_at', 'updated_at'),
+    'payments': ('card_type', 'created_at'),
+    'preauthorizations': ('client', 'payment', 'amount', 'created_at'),
+    'refunds': ('client', 'transaction', 'amount', 'created_at'),
+    'subscriptions': ('offer', 'created_at'),
+    'transactions': ('client', 'payment', 'amount', 'description', 'created_at', 'status'),
+    'webhooks': ('email', 'url', 'created_at'),
+}
+ORDERS = {
+    'clients': ('email', 'created_at'),
+    'offers': ('interval', 'amount', 'created_at', 'trial_period_days'),
+    'payments': ('created_at',),
+    'preauthorizations': ('created_at',),
+    'refunds': ('transaction', 'client', 'amount', 'created_at'),
+    'subscriptions': ('offer', 'canceled_at', 'created_at'),
+    'transactions': ('created_at', 'amount'),
+    'webhooks': ('url', 'email', 'created_at'),
+}
+# Lookups the API understands, by field (exact matches are supported for all filters)
+PUSHDOWN = {
+    'amount': ('gt', 'lt'),
+    'created_at': ('range',),
+    'updated_at': ('range',),
+}
+
+LOOKUPS = {
+    'exact': operator.eq,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'in': lambda a, b: a in b,
+    'range': lambda a, b: a is not None and b[0] <= a <= b[1],
+    'contains': lambda a, b: a is not None and b in a,
+}
+
+
+def _normalize(value):
+    """Comparable form of a value: objects by ID, dates as timestamps"""
+    if isinstance(value, date):
+        # Objects hold local times, see PaymillObject
+        return time.mktime(value.timetuple())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return type(value)(_normalize(x) for x in value)
+    return getattr(value, 'id', value)
+
+
+def _param(value):
+    value = _normalize(value)
+    if isinstance(value, float):
+        return int(value)
+    return value
+
+
+class Query(object):
+    """Lazy query over a list endpoint, e.g.::
+
+        api.transactions.filter(client=client, status='closed',
+            created_at__range=(start, end)).order_by('-created_at').limit(10)
+
+    Filters and sorting supported by the API are sent as request parameters. Other filters
+    are applied while pages are read and iteration stops as soon as ``limit`` objects are
+    found. Sorting on fields the API cannot sort on (or on several fields) reads every
+    matching object first.
+
+    Lookups: exact (default), gt, gte, lt, lte, in, range, contains.
+    """
+    def __init__(self, api, resource, filters=(), order=(), limit=None, page_size=100):
+        if resource not in FILTERS:
+            raise ValueError('Unknown resource: {0}'.format(resource))
+        self.api = api
+        self.resource = resource
+        self.filters = tuple(filters)
+        self.order = tuple(order)
+        self._limit = limit
+        self.page_size = page_size
+
+    def _clone(self, **kwargs):
+        options = dict(filters=self.filters, order=self.order, limit=self._limit,
+            page_size=self.page_size)
+        options.update(kwargs)
+        return type(self)(self.api, self.resource, **options)
+
+    def filter(self, **kwargs):
+        filters = []
+        for key, value in sorted(kwargs.items()):
+            field, _, lookup = key.partition('__')
+            lookup = lookup or 'exact'
+            if lookup not in LOOKUPS:
+                raise ValueError('Unknown lookup: {0}'.format(key))
+            filters.append((field, lookup, value))
+        return self._clone(filters=self.filters + tuple(filters))
+
+    def order_by(self, *fields):
+        return self._clone(order=fields)
+
+    def limit(self, count):
+        return self._clone(limit=count)
+
+    def _plan(self):
+        """Splits filters and sorting between API parameters and client-side work"""
+        params = {}
+        local = []
+        for field, lookup, value in self.filters:
+            param = None
+            if field not in FILTERS[self.resource] or field in params:
+                pass
+            elif lookup == 'exact':
+                param = _param(value)
+            elif lookup in PUSHDOWN.get(field, ()):
+                if lookup == 'range':
+                    bounds = [_param(x) for x in value]
+                    if None not in bounds:
+                        param = '{0}-{1}'.format(*bounds)
+                elif _param(value) is not None:
+                    param = '{0}{1}'.format(lookup == 'gt' and '>' or '<', _param(value))
+
+            # Empty values (e.g. None) are left out of requests, they are matched locally
+            if self.api._urlencode({field: param}):
+                params[field] = param
+            else:
+                local.append((field, lookup, value))
+
+        local_order = ()
+        if len(self.order) == 1 and self.order[0].lstrip('-') in ORDERS[self.resource]:
+            field = self.order[0]
+            params['order'] = '{0}_{1}'.format(field.lstrip('-'),
+                field.startswith('-') and 'desc' or 'asc')
+        else:
+            local_order = self.order
+
+        return params, local, local_order
+
+    def _match(self, obj, local):
+        for field, lookup, value in local:
+            if not LOOKUPS[lookup](_normalize(getattr(obj, field, None)), _normalize(value)):
+                return False
+        return True
+
+    def _iter_matches(self, params, local, limit):
+        count = self.page_size
+        if limit and not local:
+            count = min(count, limit)
+
+        for page in self.api.iter_pages(self.resource, count=count, **params):
+            for obj in page:
+                if self._match(obj, local):
+                    yield obj
+
+    def __iter__(self):
+        if self._limit == 0:
+            return
+
+        params, local, local_order = self._plan()
+        matches = self._iter_matches(params, local, not local_order and self._limit)
+        if local_order:
+            matches = iter(self._sorted(list(matches), local_order))
+
+        found = 0
+        for obj in matches:
+            yield obj
+            found += 1
+            if found == self._limit:
+                return
+
+    def _sorted(self, objects, order):
+        # Stable sorts, least significant field first
+        for field in reversed(order):
+            name = field.lstrip('-')
+            objects.sort(key=lambda x: _normalize(getattr(x, name, None)),
+                reverse=field.startswith('-'))
+        return objects
+
+    def first(self):
+        for obj in self.limit(1):
+            return obj
+
+    def count(self):
+        """Number of matching objects (at most ``limit``), from a single request when the API
+        filters them all"""
+        params, local, local_order = self._plan()
+        if local:
+            return sum(1 for x in islice(self._iter_matches(params, local, self._limit),
+                self._limit))
+
+        count = int(self.api._api_call('{0}/'.format(self.resource),
+            params=dict(params, count=1)).get('data_count', 0))
+        if self._limit is not None:
+            return min(count, self._limit)
+        return count
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from multiprocessing.pool import ThreadPool
+
+from .api import IdentityMap, PaymillError, PaymillObject
+
+__all__ = ('resolve',)
+
+# Paymill method fetching a single object of each type
+GETTERS = {
+    'Client': 'get_client',
+    'Offer': 'get_offer',
+    'Payment': 'get_card',
+    'Preauthorization': 'get_preauthorization',
+    'Refund': 'get_refund',
+    'Subscription': 'get_subscription',
+    'Transaction': 'get_transaction',
+    'Webhook': 'get_webhook',
+}
+
+
+def _walk(objects, known, slots):
+    """Indexes objects by (type, id) and collects typed fields holding bare IDs"""
+    stack = list(objects)
+    seen = set()
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+
+        if getattr(obj, 'id', None):
+            known.setdefault((type(obj).__name__, obj.id), obj)
+
+        for field, type_name in obj._typed_fields.items():
+            value = obj.__dict__.get(field)
+            if isinstance(value, basestring):
+                slots.append((obj, field, None, type_name, value))
+            elif isinstance(value, PaymillObject):
+                stack.append(value)
+            elif isinstance(value, list):
+                for i, x in enumerate(value):
+                    if isinstance(x, basestring):
+                        slots.append((obj, field, i, type_name, x))
+                    elif isinstance(x, PaymillObject):
+                        stack.append(x)
+
+
+def resolve(api, objects, depth=1, workers=8):
+    """Replaces bare IDs in typed fields of ``objects`` (and their nested objects) by the
+    objects themselves, in place.
+
+    IDs are deduplicated, objects already present in the collection are reused and the
+    others are fetched in parallel. Fetched objects are resolved in turn, up to ``depth``
+    levels. IDs which are not found are left as they are. Returns ``objects``.
+    """
+    known = {}
+    pool = ThreadPool(workers)
+
+    def fetch(key):
+        type_name, object_id = key
+        try:
+            return getattr(api, GETTERS[type_name])(object_id)
+        except PaymillError as e:
+            if e.code != 404:
+                raise
+
+    # Fetches of all levels are children of one span
+    span = api._span('pmill.resolve', {'paymill.depth': depth})
+    if api.tracer is not None:
+        fetch = api.tracer.wrap(fetch, span)
+    fetch = IdentityMap.wrap(fetch)
+
+    try:
+        pending = objects
+        for level in range(depth):
+            slots = []
+            _walk(pending, known, slots)
+
+            missing = sorted(set((x[3], x[4]) for x in slots) - set(known))
+            fetched = []
+            for key, obj in zip(missing, pool.map(fetch, missing)):
+                if obj is not None:
+                    known[key] = obj
+                    fetched.append(obj)
+
+            for obj, field, index, type_name, object_id in slots:
+                target = known.get((type_name, object_id))
+                if target is None:
+                    continue
+                if index is None:
+                    obj.__dict__[field] = target
+                else:
+                    obj.__dict__[field][index] = target
+
+            if not fetched:
+                break
+            pending = fetched
+    finally:
+        pool.close()
+        span.finish()
+
+    return objects
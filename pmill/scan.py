@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from multiprocessing.pool import ThreadPool
+import time
+
+from .api import RESOURCES
+
+__all__ = ('WindowScan',)
+
+
+class Window(object):
+    """Objects created from ``start`` to ``end`` (inclusive timestamps)"""
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.data_count = None
+
+
+class WindowScan(object):
+    """Reads a whole collection in created_at windows instead of one offset sequence.
+
+    The time range is split until each window holds at most ``target`` objects, using the
+    data_count of a one-object page of each window, assuming objects spread evenly in time.
+    Pages of all windows are then fetched by ``workers`` threads, a few at a time to bound
+    memory, and returned in creation order.
+    Objects created during the scan do not shift the offsets of past windows; objects seen
+    twice in a window (e.g. after a deletion) are skipped.
+    """
+    def __init__(self, api, resource, workers=8, page_size=100, target=2000, max_split=16):
+        self.api = api
+        self.resource = resource
+        self.return_type = RESOURCES[resource]
+        self.workers = workers
+        self.page_size = page_size
+        self.target = target
+        self.max_split = max_split
+
+        self.requests = 0
+        self.windows = 0
+        self.duplicates = 0
+
+    def _fetch(self, args):
+        start, end, offset, count, params = args
+        return self.api._api_call('{0}/'.format(self.resource),
+            params=dict(params, created_at='{0}-{1}'.format(start, end), order='created_at_asc',
+                count=count, offset=offset),
+            return_type=self.return_type
+        )
+
+    def _split(self, window):
+        parts = -(-window.data_count // self.target)
+        parts = min(parts, self.max_split, window.end - window.start + 1)
+        size = (window.end - window.start + 1) / parts
+        bounds = [window.start + int(round(size * x)) for x in range(parts)] + [window.end + 1]
+        return [Window(a, b - 1) for a, b in zip(bounds, bounds[1:])]
+
+    def _plan(self, pool, start, end, params):
+        """Splits the range in windows of at most ``target`` objects, returns them in order"""
+        windows = []
+        todo = [Window(start, end)]
+        while todo:
+            pages = pool.map(self._fetch, [(x.start, x.end, 0, 1, params) for x in todo])
+            self.requests += len(todo)
+            splits = []
+            for window, page in zip(todo, pages):
+                window.data_count = page.data_count
+                if window.data_count > self.target and window.end > window.start:
+                    splits.extend(self._split(window))
+                elif window.data_count:
+                    windows.append(window)
+            todo = splits
+
+        windows.sort(key=lambda x: x.start)
+        return windows
+
+    def scan(self, start=0, end=None, **params):
+        """Yields the objects created from ``start`` to ``end`` (timestamps, inclusive, ``end``
+        defaults to now) in creation order. ``params`` are passed as extra filters."""
+        end = int(end or time.time())
+        pool = ThreadPool(self.workers)
+        try:
+            windows = self._plan(pool, int(start), end, params)
+            self.windows = len(windows)
+
+            tasks = [
+                (window, offset) for window in windows
+                for offset in range(0, window.data_count, self.page_size)
+            ]
+            pages = {}
+            batch = self.workers * 2
+            done = 0
+            for window in windows:
+                seen = set()
+                items = []
+
+                while done < len(tasks) and tasks[done][0] is window:
+                    if not pages:
+                        chunk = tasks[done:done + batch]
+                        self.requests += len(chunk)
+                        pages = dict(zip(range(done, done + len(chunk)), pool.map(
+                            self._fetch, [(w.start, w.end, o, self.page_size, params)
+                                for w, o in chunk]
+                        )))
+                    items.extend(pages.pop(done))
+                    done += 1
+
+                items.sort(key=lambda x: x.created_at)
+                for x in items:
+                    if x.id in seen:
+                        self.duplicates += 1
+                        continue
+                    seen.add(x.id)
+                    yield x
+        finally:
+            pool.close()
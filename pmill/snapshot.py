@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from collections import namedtuple
+from datetime import datetime
+import hashlib
+import json
+import sqlite3
+import time
+
+from .api import PaymillList, PaymillObject
+
+__all__ = ('ADDED', 'CHANGED', 'Change', 'REMOVED', 'SnapshotIndex', 'content_hash')
+
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+# ``fields`` maps field names to (old, new) values: changed fields only for changed objects,
+# all fields for added and removed objects (with None as old and new value respectively)
+Change = namedtuple('Change', ('kind', 'id', 'fields'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    id TEXT PRIMARY KEY,
+    hash BLOB NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def _normalize(value):
+    """JSON compatible value: nested objects by ID, dates as timestamps"""
+    if value is None or isinstance(value, basestring):
+        return value
+    if isinstance(value, PaymillObject):
+        return value.id
+    if isinstance(value, datetime):
+        # Objects hold local times, see PaymillObject
+        return int(time.mktime(value.timetuple()))
+    if isinstance(value, (list, tuple)):
+        return [_normalize(x) for x in value]
+    return value
+
+
+def _encode(obj):
+    """Returns the fields of ``obj`` as canonical JSON and its hash"""
+    # (field, value) pairs in Meta order: a dict would need sort_keys, which is much slower
+    values = obj.__dict__
+    data = _encoder.encode([(x, _normalize(values.get(x))) for x in obj._fields])
+    return data, buffer(hashlib.sha1(data.encode('utf-8')).digest())
+
+
+def content_hash(obj):
+    """SHA-1 of the values of the Meta fields of ``obj``"""
+    return bytes(_encode(obj)[1])
+
+
+class SnapshotIndex(object):
+    """Field values and content hashes of the last snapshot of a collection, in SQLite.
+
+    ``diff()`` compares a new snapshot with the stored one while reading it, so neither side
+    is held in memory: unchanged objects are told apart by their hash alone and stored values
+    are only decoded for changed objects.
+    """
+    def __init__(self, path, batch_size=500):
+        self.batch_size = batch_size
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+
+    def _objects(self, snapshot):
+        for x in snapshot:
+            if isinstance(x, PaymillList):
+                for y in x:
+                    yield y
+            else:
+                yield x
+
+    def _batches(self, snapshot):
+        batch = []
+        for obj in self._objects(snapshot):
+            batch.append(obj)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def diff(self, snapshot, update=True):
+        """Yields a Change for each object of ``snapshot`` (objects or pages) added or changed
+        since the stored snapshot, then for each removed object. Once fully read, the new
+        snapshot replaces the stored one unless ``update`` is false."""
+        db = self._db
+        db.executescript('DROP TABLE IF EXISTS staging;'
+            + SCHEMA.replace('objects', 'staging'))
+
+        for batch in self._batches(snapshot):
+            rows = [(x.id,) + _encode(x) for x in batch]
+            stored = dict(
+                (x[0], x[1:]) for x in db.execute(
+                    'SELECT id, hash, data FROM objects WHERE id IN ({0})'.format(
+                        ','.join('?' * len(rows))), [x[0] for x in rows]
+                )
+            )
+            db.executemany('INSERT OR REPLACE INTO staging (id, data, hash) VALUES (?, ?, ?)',
+                rows)
+
+            for object_id, data, digest in rows:
+                old = stored.get(object_id)
+                if old is None:
+                    yield Change(ADDED, object_id, dict(
+                        (k, (None, v)) for k, v in json.loads(data)))
+                elif old[0] != digest:
+                    old, new = dict(json.loads(old[1])), dict(json.loads(data))
+                    yield Change(CHANGED, object_id, dict(
+                        (k, (old.get(k), new.get(k))) for k in set(old) | set(new)
+                        if old.get(k) != new.get(k)
+                    ))
+
+        for object_id, data in db.execute(
+            'SELECT o.id, o.data FROM objects o LEFT JOIN staging s ON o.id = s.id'
+            ' WHERE s.id IS NULL'
+        ):
+            yield Change(REMOVED, object_id, dict(
+                (k, (v, None)) for k, v in json.loads(data)))
+
+        if update:
+            db.executescript('DROP TABLE objects; ALTER TABLE staging RENAME TO objects;')
+        else:
+            db.executescript('DROP TABLE staging;')
+
+    def close(self):
+        self._db.close()
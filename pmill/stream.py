@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import codecs
+import json
+import re
+
+from .api import _LOCAL, RESOURCES, _build
+
+__all__ = ('ItemStream', 'iter_envelope', 'stream')
+
+ITEM = object()
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DECODER = json.JSONDecoder()
+
+
+class _Reader(object):
+    """Decodes JSON values from a file object, reading chunks as needed"""
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def fill(self):
+        if self.eof:
+            raise ValueError('Unexpected end of JSON data')
+
+        data = self.fp.read(self.chunk_size)
+        self.eof = not data
+        # Only the part not decoded yet is kept
+        self.buf = self.buf[self.pos:] + self._decoder.decode(data, final=self.eof)
+        self.pos = 0
+
+    def peek(self):
+        """Returns the next non-whitespace character"""
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self.fill()
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('Expecting one of {0!r}, got {1!r}'.format(chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buf, self.pos)
+                # A value ending with the buffer (e.g. a number) may go on in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_envelope(fp, chunk_size=8192):
+    """Parses a JSON object from ``fp`` incrementally.
+
+    Yields (key, value) pairs, except for the items of a "data" list which are yielded as
+    (ITEM, item) as soon as each one is read. Only one item is held in memory at a time.
+    """
+    reader = _Reader(fp, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+
+    while True:
+        key = reader.value()
+        if not isinstance(key, unicode):
+            raise ValueError('Expecting a property name, got {0!r}'.format(key))
+        reader.expect(':')
+
+        if key == 'data' and reader.peek() == '[':
+            reader.pos += 1
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield ITEM, reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            yield key, reader.value()
+
+        if reader.expect(',}') == '}':
+            break
+
+
+class ItemStream(object):
+    """Objects of a list response, built as their data is received.
+
+    The request is sent on creation. ``data_count`` is set as soon as it is read: before
+    iterating if the API sends it before the items, at the end otherwise. The connection is
+    released once all items are read or on ``close()``.
+    """
+    def __init__(self, api, endpoint, return_type, params=None, chunk_size=8192):
+        self.return_type = return_type
+        self.data_count = None
+        self._events = self._read(api._call(endpoint, params), chunk_size)
+        self._first = next(self._events, None)
+
+    def _read(self, call, chunk_size):
+        with call as response:
+            for key, value in iter_envelope(response, chunk_size):
+                if key is ITEM:
+                    yield value
+                elif key == 'data_count':
+                    self.data_count = int(value)
+
+    def __iter__(self):
+        if self._first is None:
+            return
+        item, self._first = self._first, None
+
+        identity_map = getattr(_LOCAL, 'identity_map', None)
+        yield _build(self.return_type, item, identity_map)
+        for item in self._events:
+            yield _build(self.return_type, item, identity_map)
+
+    def close(self):
+        self._first = None
+        self._events.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def stream(api, resource, chunk_size=8192, **params):
+    """Returns an ItemStream of a list endpoint (e.g. "transactions")::
+
+        with stream(api, 'transactions', count=100) as items:
+            print(items.data_count)
+            for transaction in items:
+                ...
+    """
+    return ItemStream(api, '{0}/'.format(resource), RESOURCES[resource], params, chunk_size)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import binascii
+from contextlib import contextmanager
+from functools import wraps
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+__all__ = ('FileExporter', 'Span', 'Tracer')
+
+LOGGER = logging.getLogger(__name__)
+
+# W3C Trace Context header: version, trace ID, parent span ID, flags
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+
+def _new_id(size):
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+class Span(object):
+    """Timed operation of a trace, with the identifiers, attributes and status of an
+    OpenTelemetry span.
+
+    Used as a context manager, the span is the current span of the thread (the parent of
+    spans started meanwhile) and ends when the block exits; an exception sets the error
+    status.
+    """
+    def __init__(self, tracer, name, trace_id, parent_id=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.status = 'UNSET'
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def traceparent(self):
+        """W3C traceparent header value making this span the parent of remote spans"""
+        return '00-{0}-{1}-01'.format(self.trace_id, self.span_id)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @contextmanager
+    def activate(self):
+        """Makes the span current in the block without ending it"""
+        self.tracer._push(self)
+        try:
+            yield self
+        finally:
+            self.tracer._pop(self)
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.time()
+            self.tracer._export(self)
+
+    def __enter__(self):
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.tracer._pop(self)
+        if exc_type is not None:
+            self.status = 'ERROR'
+            self.attributes.setdefault('error.type', exc_type.__name__)
+        self.finish()
+
+    def to_dict(self):
+        """Span fields, named as in OTLP JSON"""
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'startTimeUnixNano': int(self.start * 1e9),
+            'endTimeUnixNano': int((self.end or self.start) * 1e9),
+            'attributes': self.attributes,
+            'status': {'code': self.status},
+        }
+
+
+class NoopSpan(object):
+    """Stands for a span when tracing is disabled"""
+    traceparent = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    @contextmanager
+    def activate(self):
+        yield self
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer(object):
+    """Creates spans and hands finished ones to ``exporter``, any object with an
+    ``export(span)`` method.
+
+    The parent of a span is the current span of the thread unless given. Work run on other
+    threads keeps its parent through ``wrap()``; traces started by other services are
+    continued from their W3C ``traceparent`` header.
+    """
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _push(self, span):
+        self._stack().append(span)
+
+    def _pop(self, span):
+        stack = self._stack()
+        if span in stack:
+            stack.remove(span)
+
+    def _export(self, span):
+        if self.exporter is None:
+            return
+        try:
+            self.exporter.export(span)
+        except Exception:
+            LOGGER.exception('Failed to export span %s', span.name)
+
+    def current(self):
+        stack = self._stack()
+        return stack and stack[-1] or None
+
+    def span(self, name, attributes=None, parent=None, traceparent=None):
+        """Returns a new span, child of ``parent``, of the remote span of a ``traceparent``
+        header or of the current span"""
+        if parent is None and traceparent:
+            match = TRACEPARENT.match(traceparent.strip().lower())
+            if match is not None:
+                return Span(self, name, match.group(1), match.group(2), attributes)
+        parent = parent or self.current()
+        if parent is None:
+            return Span(self, name, _new_id(16), None, attributes)
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    def wrap(self, func, parent=None):
+        """Returns ``func`` running with ``parent`` (default: the current span) as its current
+        span, e.g. in a thread pool"""
+        parent = parent or self.current()
+        if parent is None:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with parent.activate():
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class FileExporter(object):
+    """Appends finished spans to a file, one JSON object per line"""
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = io.open(path, 'a', encoding='utf-8')
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=repr)
+        with self._lock:
+            self._file.write('{0}\n'.format(line))
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
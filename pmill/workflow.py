@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+__all__ = ('Workflow', 'WorkflowError')
+
+
+class WorkflowError(Exception):
+    """A step failed. ``results`` holds the results of the steps which succeeded,
+    ``compensation_errors`` the errors of compensating actions by step name."""
+    def __init__(self, step, error, results, compensation_errors):
+        super(WorkflowError, self).__init__(
+            'Step "{0}" failed: {1!r}'.format(step, error)
+        )
+        self.step = step
+        self.error = error
+        self.results = results
+        self.compensation_errors = compensation_errors
+
+
+class Ref(object):
+    """Attribute of the result of a step, resolved when the step is done"""
+    def __init__(self, step, attr):
+        self.step = step
+        self.attr = attr
+
+    def resolve(self, results):
+        return getattr(self.step.resolve(results), self.attr)
+
+
+class Step(object):
+    def __init__(self, name, func, args, kwargs, compensate, after):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.compensate = compensate
+        self.depends = set(after)
+
+        for x in list(args) + list(kwargs.values()):
+            if isinstance(x, (Step, Ref)):
+                self.depends.add(isinstance(x, Ref) and x.step or x)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return Ref(self, name)
+
+    def resolve(self, results):
+        return results[self.name]
+
+
+def _resolve(value, results):
+    if isinstance(value, (Step, Ref)):
+        return value.resolve(results)
+    return value
+
+
+class Workflow(object):
+    """Runs dependent API calls, each one as soon as the calls it depends on are done.
+
+    Results of earlier steps (or their attributes) are passed as arguments, which makes the
+    dependencies::
+
+        workflow = Workflow(api)
+        client = workflow.step('client', 'new_client', email, compensate='delete_client')
+        offer = workflow.step('offer', 'get_offer', offer_id)
+        card = workflow.step('card', 'new_card', token, client.id, compensate='delete_card')
+        workflow.step('subscription', 'new_subscription', client, offer, card)
+        results = workflow.run()
+
+    Independent steps run concurrently, on ``workers`` threads. When a step fails, no other
+    step is started and the compensating actions of the steps done are run, in reverse
+    order, before WorkflowError is raised. Calls are Paymill method names or callables;
+    compensating actions are called with the ID of the step result (method names) or with
+    the result itself (callables).
+    """
+    def __init__(self, api, workers=4):
+        self.api = api
+        self.workers = workers
+        self.steps = OrderedDict()
+
+    def step(self, name, func, *args, **kwargs):
+        """Adds a step, ``compensate`` and ``after`` (steps to wait for without using their
+        results) are keyword only. Returns the step, to be used as an argument of others."""
+        compensate = kwargs.pop('compensate', None)
+        after = kwargs.pop('after', ())
+        if name in self.steps:
+            raise ValueError('Duplicate step: {0}'.format(name))
+
+        step = Step(name, func, args, kwargs, compensate, after)
+        unknown = [x.name for x in step.depends if self.steps.get(x.name) is not x]
+        if unknown:
+            raise ValueError('Unknown steps: {0}'.format(', '.join(unknown)))
+
+        self.steps[name] = step
+        return step
+
+    def _call(self, step, results):
+        func = step.func
+        if not callable(func):
+            func = getattr(self.api, func)
+        try:
+            return step, func(
+                *[_resolve(x, results) for x in step.args],
+                **dict((k, _resolve(v, results)) for k, v in step.kwargs.items())
+            ), None
+        except Exception as e:
+            return step, None, e
+
+    def _compensate(self, done, results):
+        errors = {}
+        for step in reversed(done):
+            if step.compensate is None:
+                continue
+            result = results[step.name]
+            try:
+                if callable(step.compensate):
+                    step.compensate(result)
+                else:
+                    getattr(self.api, step.compensate)(getattr(result, 'id', result))
+            except Exception as e:
+                errors[step.name] = e
+        return errors
+
+    def run(self):
+        """Runs the steps, returns their results by name"""
+        results = {}
+        done = []
+        pending = OrderedDict(self.steps)
+        running = 0
+        failure = None
+        queue = Queue()
+        pool = ThreadPool(self.workers)
+
+        try:
+            while True:
+                if failure is None:
+                    ready = [x for x in pending.values()
+                        if all(d.name in results for d in x.depends)]
+                    for step in ready:
+                        del pending[step.name]
+                        running += 1
+                        # results is only written by this thread, between calls
+                        pool.apply_async(self._call, (step, dict(results)), callback=queue.put)
+
+                if not running:
+                    break
+
+                step, result, error = queue.get()
+                running -= 1
+                if error is not None:
+                    failure = failure or (step.name, error)
+                else:
+                    results[step.name] = result
+                    done.append(step)
+        finally:
+            pool.close()
+
+        if failure is not None:
+            errors = self._compensate(done, results)
+            raise WorkflowError(failure[0], failure[1], results, errors)
+
+        return OrderedDict((x, results[x]) for x in self.steps)
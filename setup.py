@@ -18,7 +18,15 @@ setup(
     url='https://github.com/olivier-m/pmill',
     license='MIT License',
     install_requires=[],
+    extras_require={
+        'http2': ['hyper'],
+        'parquet': ['pyarrow'],
+        'projection': ['numpy'],
+    },
     packages=['pmill'],
+    entry_points={
+        'console_scripts': ['pmill = pmill.cli:main'],
+    },
     test_suite='tests.MockTestCase',
     classifiers=[
         'Development Status :: 5 - Production/Stable',
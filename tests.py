@@ -1,17 +1,58 @@
 # -*- coding: utf-8 -*-
 from __future__ import (print_function, division, absolute_import, unicode_literals)
 
-from datetime import date
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import calendar
+import httplib
+from datetime import date, datetime
 import json
 import os.path
 import re
+import shutil
+import socket
+from StringIO import StringIO
+from SocketServer import BaseRequestHandler, TCPServer, ThreadingMixIn
+import sys
+import tempfile
+import threading
 import time
 from urllib import urlencode
-from urllib2 import urlopen
+import zlib
+from urllib2 import ProxyHandler, build_opener, urlopen
 from urlparse import parse_qs
 import unittest
 
-from pmill import Paymill, PaymillError
+from pmill import Paymill, PaymillError, PaymillPool
+from pmill.cassette import Cassette, RecordProcessor, ReplayHandler
+from pmill.connection import KeepAliveHandler
+from pmill.aggregate import SettlementAggregates, Totals
+from pmill.api import (Client, IdentityMap, Offer, PaymillList, Preauthorization, Refund,
+    Subscription, Transaction, decode_data)
+from pmill.decode import ParallelDecoder
+from pmill.export import Exporter
+from pmill.hedge import Hedger
+from pmill.limiter import AdaptiveLimiter
+from pmill import loadtest
+from pmill.outbox import Outbox
+from pmill.preauth import RELEASE, PreauthScheduler
+from pmill.projection import HAS_NUMPY, SubscriptionArrays, parse_interval
+from pmill.priority import BACKGROUND, INTERACTIVE, PriorityScheduler
+from pmill.profiling import Profiler
+from pmill.resolve import resolve
+from pmill.workflow import Workflow, WorkflowError
+from pmill.scan import WindowScan
+from pmill.trace import FileExporter, Tracer
+from pmill.snapshot import ADDED, CHANGED, REMOVED, SnapshotIndex
+from pmill.stream import ITEM, iter_envelope, stream
+from pmill import http2
+from pmill.http2 import HAS_HTTP2
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
 
 BRIDGE_URL = "https://test-token.paymill.com/"
 
@@ -33,6 +74,162 @@ class MockPaymill(Paymill):
         }
 
 
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def respond(self, code, body, headers=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = length and self.rfile.read(length) or None
+        self.server.requests.append((self.command, self.path, dict(self.headers), body))
+        route = self.server.routes.get(self.path.split('?')[0], (404, '{"error": "Not Found"}'))
+        if callable(route):
+            route = route(self)
+        headers = {'Content-Type': 'application/json'}
+        if len(route) > 2:
+            headers.update(route[2])
+        self.respond(route[0], route[1], headers)
+
+    do_POST = do_PUT = do_DELETE = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the Paymill API"""
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, routes=None, handler=StubHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.routes = routes or {}
+        self.requests = []
+        self.connections = 0
+        self.base_url = 'http://127.0.0.1:{0}/v2/'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # Clients closing responses early reset the connection
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TunnelProxyHandler(BaseRequestHandler):
+    def _pipe(self, source, target):
+        try:
+            while True:
+                data = source.recv(65535)
+                if not data:
+                    break
+                target.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            target.close()
+
+    def handle(self):
+        data = b''
+        while b'\r\n\r\n' not in data:
+            chunk = self.request.recv(65535)
+            if not chunk:
+                return
+            data += chunk
+        head, _, rest = data.partition(b'\r\n\r\n')
+        self.server.requests.append(head.split(b'\r\n'))
+
+        # Every tunnel leads to the target, whatever the host asked for
+        upstream = socket.create_connection(self.server.target)
+        self.request.sendall(b'HTTP/1.0 200 Connection established\r\n\r\n')
+        if rest:
+            upstream.sendall(rest)
+        thread = threading.Thread(target=self._pipe, args=(upstream, self.request))
+        thread.daemon = True
+        thread.start()
+        self._pipe(self.request, upstream)
+        thread.join()
+
+
+class TunnelProxyServer(ThreadingMixIn, TCPServer):
+    """Local proxy tunnelling CONNECT requests to ``target``"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, target):
+        TCPServer.__init__(self, ('127.0.0.1', 0), TunnelProxyHandler)
+        self.target = target
+        self.requests = []
+        self.address = '127.0.0.1:{0}'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class H2StubHandler(BaseRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        self.request.sendall(conn.data_to_send())
+
+        while True:
+            data = self.request.recv(65535)
+            if not data:
+                break
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    path = dict(event.headers)[b':path']
+                    code, body = self.server.routes.get(path.split(b'?')[0], (404, b'{}'))
+                    conn.send_headers(event.stream_id, [
+                        (b':status', str(code).encode()),
+                        (b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode()),
+                    ])
+                    conn.send_data(event.stream_id, body, end_stream=True)
+            self.request.sendall(conn.data_to_send())
+
+
+class H2StubServer(ThreadingMixIn, TCPServer):
+    """Local HTTP/2 (cleartext, prior knowledge) stand-in for the Paymill API"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, routes=None):
+        TCPServer.__init__(self, ('127.0.0.1', 0), H2StubHandler)
+        self.routes = routes or {}
+        self.connections = 0
+        self.base_url = 'http://127.0.0.1:{0}/v2/'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
 class MockTestCase(unittest.TestCase):
     def setUp(self):
         self.api = MockPaymill('fake-key')
@@ -41,6 +238,26 @@ class MockTestCase(unittest.TestCase):
         r = getattr(self.api, _method)(*args, **kwargs)
         return self.assertEqual(r['endpoint'], _endpoint)
 
+    def test_prepare_call(self):
+        r = self.api.get_transactions()
+        self.assertEqual(r['url'], 'https://api.paymill.com/v2/transactions/')
+        self.assertEqual(dict(r['opener'].addheaders)['Authorization'], 'Basic ZmFrZS1rZXk6')
+        self.assertTrue(self.api.get_clients()['opener'] is r['opener'])
+        self.assertTrue(self.api.export_clients()['opener'] is not r['opener'])
+
+        self.api.private_key = 'other-key'
+        r = self.api.get_transactions()
+        self.assertEqual(dict(r['opener'].addheaders)['Authorization'], 'Basic b3RoZXIta2V5Og==')
+
+        api = MockPaymill('fake-key', base_url='http://127.0.0.1:8000/v2/')
+        self.assertEqual(api.get_offer('offer_1234')['url'],
+            'http://127.0.0.1:8000/v2/offers/offer_1234')
+
+    def test_urlencode(self):
+        self.assertEqual(parse_qs(self.api._urlencode({
+            'a': None, 'b': 'None', 'c': '', 'd': [], 'e': 0, 'f': ['x', None, ''], 'g': [None]
+        })), {'e': ['0'], 'f[]': ['x']})
+
     def test_cards(self):
         r = self.api.new_card('tok_1234')
         self.assertEqual(r['endpoint'], 'payments/')
@@ -256,6 +473,1245 @@ class MockTestCase(unittest.TestCase):
         self.assertEqual(r['method'], 'GET')
         self.assertEqual(r['params'], {'count': 1, 'offset': 5})
 
+    def test_keep_alive(self):
+        server = StubServer({
+            '/v2/clients/cli_1': (200, '{"data": {"id": "cli_1", "email": "a@example.net",'
+                + ' "created_at": 1400000000, "updated_at": 1400000000}}'),
+        })
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, max_connections=2)
+            for x in range(5):
+                self.assertEqual(api.get_client('cli_1').email, 'a@example.net')
+            self.assertRaises(PaymillError, api.get_client, 'cli_2')
+            self.assertEqual(api.get_client('cli_1').id, 'cli_1')
+
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(api.connections.idle_connections, 1)
+            self.assertEqual(api.metrics['calls'], 7)
+            self.assertEqual(api.metrics['errors'], 1)
+
+            api.close()
+            self.assertEqual(api.connections.open_connections, 0)
+        finally:
+            server.stop()
+
+    def test_keep_alive_headers(self):
+        server = StubServer({
+            '/v2/clients/cli_1': (200, '{"data": {"id": "cli_1", "created_at": 1400000000,'
+                + ' "updated_at": 1400000000}}'),
+            '/v2/clients/': (200, '"id";"email"\n"cli_1";"a@example.net"\n'),
+        })
+        try:
+            # Openers with different headers share the connections
+            api = Paymill('fake-key', base_url=server.base_url, max_connections=2)
+            api.get_client('cli_1')
+            self.assertTrue(api.export_clients().startswith('"id"'))
+            self.assertEqual(api.get_client('cli_1').id, 'cli_1')
+            self.assertEqual([x[2].get('accept') for x in server.requests],
+                [None, 'text/csv', None])
+            api.close()
+        finally:
+            server.stop()
+
+    def test_keep_alive_proxy(self):
+        class Handler(KeepAliveHandler):
+            def https_open(self, req):
+                # Plain HTTP inside the tunnel, the stub server does not speak TLS
+                return self.do_open(httplib.HTTPConnection, req)
+
+        server = StubServer({
+            '/v2/clients/cli_1': (200, '{"data": {"id": "cli_1", "created_at": 1400000000,'
+                + ' "updated_at": 1400000000}}'),
+        })
+        proxy = TunnelProxyServer(server.server_address)
+        try:
+            handler = Handler(2)
+            opener = build_opener(
+                ProxyHandler({'https': 'http://user:secret@{0}'.format(proxy.address)}), handler)
+            for x in range(2):
+                response = opener.open('https://api.example.com/v2/clients/cli_1', timeout=5)
+                self.assertEqual(json.loads(response.read())['data']['id'], 'cli_1')
+                response.close()
+
+            # One tunnel, reused, authenticated with the proxy only
+            self.assertEqual(len(proxy.requests), 1)
+            # Port 443 with HTTPSConnection
+            self.assertEqual(proxy.requests[0][0], b'CONNECT api.example.com:80 HTTP/1.0')
+            self.assertTrue(b'Proxy-Authorization: Basic dXNlcjpzZWNyZXQ=' in proxy.requests[0])
+            self.assertEqual([x[1] for x in server.requests], ['/v2/clients/cli_1'] * 2)
+            self.assertFalse(any('proxy-authorization' in x[2] for x in server.requests))
+            self.assertEqual(handler.idle_connections, 1)
+            handler.close()
+        finally:
+            proxy.stop()
+            server.stop()
+
+    def test_pool(self):
+        server = StubServer({
+            '/v2/transactions/': (200, '{"data": [{"id": "tran_1", "created_at": 1400000000,'
+                + ' "updated_at": 1400000000}], "data_count": 1}'),
+        })
+        try:
+            pool = PaymillPool(max_connections=2, connections_per_account=1,
+                base_url=server.base_url)
+            for x in range(3):
+                pool.register('shop{0}'.format(x), 'key{0}'.format(x))
+
+            # Each call leaves an idle connection, the third account evicts the first one
+            for account in pool.accounts:
+                pool[account].get_transactions()
+            self.assertEqual(pool.open_connections, 2)
+            self.assertEqual(list(pool.metrics()), ['shop1', 'shop2'])
+
+            result = pool.merge('get_transactions', created_at='1-2')
+            self.assertEqual(result.data_count, 3)
+            self.assertEqual([x.id for x in result], ['tran_1'] * 3)
+            self.assertTrue(pool.open_connections <= 2)
+
+            auth = set(x[2]['authorization'] for x in server.requests)
+            self.assertEqual(len(auth), 3)
+
+            pool.close()
+            self.assertEqual(pool.metrics(), {})
+            self.assertEqual(pool.open_connections, 0)
+
+            # Clients dropped by the pool keep working without holding connections
+            orphans = [pool['shop0'], pool['shop1']]
+            for client in orphans:
+                client.get_transactions()
+            pool['shop2'].get_transactions()
+            for client in orphans:
+                client.get_transactions()
+            self.assertEqual(len(pool['shop2'].get_transactions()), 1)
+            pool.close()
+            self.assertEqual(pool.open_connections, 0)
+        finally:
+            server.stop()
+
+    def test_compress(self):
+        items = ', '.join('{{"id": "cli_{0}", "email": "client{0}@example.net",'
+            ' "created_at": 1400000000, "updated_at": 1400000000}}'.format(x) for x in range(500))
+        body = '{{"data": [{0}], "data_count": 500}}'.format(items)
+        gz = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gz_body = gz.compress(body) + gz.flush()
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        csv = '"id";"email"\n' + '"cli_1";"a@example.net"\n' * 100
+
+        server = StubServer({
+            '/v2/clients/': (200, gz_body, {'Content-Encoding': 'gzip'}),
+            '/v2/offers/': (200, raw.compress(csv) + raw.flush(), {'Content-Encoding': 'deflate'}),
+        })
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, compress=True)
+            clients = api.get_clients()
+            self.assertEqual(len(clients), 500)
+            self.assertEqual(clients[-1].email, 'client499@example.net')
+            self.assertEqual(server.requests[0][2]['accept-encoding'], 'gzip, deflate')
+            self.assertEqual(api.metrics['bytes_received'], len(gz_body))
+            self.assertEqual(api.metrics['bytes_decoded'], len(body))
+            self.assertEqual(api.metrics['bytes_saved'], len(body) - len(gz_body))
+
+            self.assertEqual(api._api_call('offers/', parse_json=False), csv)
+        finally:
+            server.stop()
+
+    def test_parallel_decoder(self):
+        def page(offset):
+            return json.dumps({'data_count': 30, 'data': [{
+                'id': 'tran_{0}'.format(offset + x), 'created_at': 1400000000,
+                'updated_at': 1400000000,
+                'client': {'id': 'cli_1', 'created_at': 1400000000, 'updated_at': 1400000000},
+                'refunds': [{'id': 'ref_{0}'.format(offset + x), 'created_at': 1400000000,
+                    'updated_at': 1400000000}],
+            } for x in range(10)]})
+
+        server = StubServer({
+            '/v2/transactions/': lambda r: (
+                200, page(int(parse_qs(r.path.split('?')[1])['offset'][0]))
+            ),
+        })
+        try:
+            api = Paymill('fake-key', base_url=server.base_url)
+            with ParallelDecoder(2) as decoder:
+                pages = list(decoder.get_pages(api, 'transactions', [20, 0, 10], count=10))
+
+            self.assertEqual([x.data_count for x in pages], [30] * 3)
+            self.assertEqual([x[0].id for x in pages], ['tran_20', 'tran_0', 'tran_10'])
+            self.assertTrue(isinstance(pages[0][0], Transaction))
+            self.assertEqual(pages[0][0].client.id, 'cli_1')
+            self.assertEqual(pages[0][9].refunds[0].id, 'ref_29')
+
+            # Download errors reach the caller, after the pages before them
+            with ParallelDecoder(2) as decoder:
+                pages = decoder.get_pages(api, 'transactions', [0, 5, 10], count=5)
+                server.routes['/v2/transactions/'] = lambda r: (
+                    'offset=5' in r.path and (500, '{}') or (200, page(0)))
+                self.assertEqual(next(pages)[0].id, 'tran_0')
+                with self.assertRaises(PaymillError) as e:
+                    list(pages)
+                self.assertEqual(e.exception.code, 500)
+
+                del server.routes['/v2/transactions/']
+                with self.assertRaises(PaymillError) as e:
+                    list(decoder.get_pages(api, 'transactions', [0]))
+                self.assertEqual(e.exception.code, 404)
+
+                # Downloads stay within the read-ahead of a slow consumer
+                server.routes['/v2/transactions/'] = (200, page(0))
+                del server.requests[:]
+                pages = decoder.get_pages(api, 'transactions', range(0, 200, 10), workers=2)
+                self.assertEqual(decoder.processes * 2, 4)
+                for x in range(3):
+                    next(pages)
+                    time.sleep(0.2)
+                    self.assertTrue(len(server.requests) <= x + 5, len(server.requests))
+                self.assertEqual(len(list(pages)), 17)
+                self.assertEqual(len(server.requests), 20)
+        finally:
+            server.stop()
+
+    def test_hedge(self):
+        calls = []
+
+        def slow_once(r):
+            calls.append(r.path)
+            if len(calls) == 2:
+                time.sleep(1)
+            return (200, '{"data": {"id": "cli_1", "created_at": 1400000000,'
+                ' "updated_at": 1400000000}}')
+
+        server = StubServer({'/v2/clients/cli_1': slow_once, '/v2/clients/': slow_once})
+        try:
+            hedger = Hedger(delay=0.2, max_ratio=0.5)
+            api = Paymill('fake-key', base_url=server.base_url, hedge=hedger)
+            self.assertEqual(api.get_client('cli_1').id, 'cli_1')
+
+            start = time.time()
+            self.assertEqual(api.get_client('cli_1').id, 'cli_1')
+            self.assertTrue(time.time() - start < 0.8)
+            self.assertEqual((hedger.calls, hedger.hedges, hedger.hedge_wins), (2, 1, 1))
+            # The latency of a hedged call includes the hedge delay
+            self.assertTrue(hedger._latencies[-1] >= 0.2)
+
+            # No budget left for another hedge, list calls are never hedged
+            self.assertRaises(PaymillError, api.get_client, 'cli_2')
+            api.get_clients()
+            self.assertEqual((hedger.calls, hedger.hedges), (3, 1))
+            api.close()
+
+            # Concurrent calls are not queued behind each other
+            def slow(r):
+                time.sleep(0.3)
+                return (200, '{"data": {"id": "cli_1", "created_at": 1400000000,'
+                    ' "updated_at": 1400000000}}')
+            server.routes['/v2/clients/cli_1'] = slow
+            hedger = Hedger(delay=5)
+            api = Paymill('fake-key', base_url=server.base_url, hedge=hedger)
+            threads = [threading.Thread(target=api.get_client, args=('cli_1',))
+                for x in range(40)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertTrue(time.time() - start < 1.5)
+            self.assertEqual((hedger.calls, hedger.hedges, len(hedger._sorted)), (40, 0, 40))
+            api.close()
+        finally:
+            server.stop()
+
+    def test_adaptive_limiter(self):
+        limiter = AdaptiveLimiter(initial=4, max_limit=6, min_slow=10)
+        for x in range(40):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 6)
+
+        # Overload errors halve the limit once per round of requests, other errors are ignored
+        starts = [limiter.acquire() for x in range(3)]
+        limiter.release(starts[0], PaymillError(50500, 'General timeout.'))
+        limiter.release(starts[1], PaymillError(500, 'Server Error'))
+        limiter.release(starts[2], PaymillError(40401, 'Amount too low or zero.'))
+        self.assertEqual(limiter.limit, 3)
+
+        # Latencies are compared with those of the same kind of call
+        limiter = AdaptiveLimiter(initial=16, max_limit=16)
+        for x in range(200):
+            key, latency = x % 2 and ('GET clients/', 0.25) or ('GET clients/:id', 0.02)
+            limiter.release(limiter.acquire() - latency, key=key)
+        self.assertEqual(limiter.limit, 16)
+        limiter.release(limiter.acquire() - 0.25, key='GET clients/:id')
+        self.assertEqual(limiter.limit, 8)
+
+        limiter = AdaptiveLimiter(initial=3)
+        server = StubServer({
+            '/v2/offers/': (500, '{"error": "boom"}'),
+            '/v2/clients/client_1': (200, '{"data": {"id": "client_1", "created_at": 1400000000,'
+                + ' "updated_at": 1400000000}}'),
+        })
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, limiter=limiter)
+            self.assertRaises(PaymillError, api.get_offers)
+            self.assertEqual(limiter.limit, 1.5)
+            self.assertEqual(limiter.in_flight, 0)
+            self.assertEqual(api.get_client('client_1').id, 'client_1')
+            self.assertEqual(list(limiter.baselines), ['GET clients/:id'])
+            self.assertEqual(limiter.in_flight, 0)
+        finally:
+            server.stop()
+
+    def test_priority(self):
+        scheduler = PriorityScheduler(max_concurrency=2, background=1)
+        self.assertEqual(scheduler.classify('GET', 'transactions/'), BACKGROUND)
+        self.assertEqual(scheduler.classify('POST', 'transactions/'), INTERACTIVE)
+        with scheduler.lane(BACKGROUND):
+            self.assertEqual(scheduler.classify('POST', 'transactions/'), BACKGROUND)
+
+        order = []
+
+        def run(lane):
+            scheduler.acquire(lane)
+            order.append(lane)
+            scheduler.release(lane)
+
+        scheduler.acquire(BACKGROUND)
+        scheduler.acquire(INTERACTIVE)
+        threads = [threading.Thread(target=run, args=(x,)) for x in (BACKGROUND, INTERACTIVE)]
+        for t in threads:
+            t.start()
+            time.sleep(0.05)
+        scheduler.release(BACKGROUND)
+        time.sleep(0.05)
+        scheduler.release(INTERACTIVE)
+        for t in threads:
+            t.join()
+        self.assertEqual(order, [INTERACTIVE, BACKGROUND])
+
+        # Lanes follow hedged calls to the threads running them
+        lanes = []
+
+        def client(handler):
+            lanes.append(dict(scheduler.running))
+            return (200, '{"data": {"id": "cli_1", "created_at": 1400000000,'
+                ' "updated_at": 1400000000}}')
+
+        server = StubServer({'/v2/clients/cli_1': client})
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, scheduler=scheduler, hedge=True)
+            with scheduler.lane(BACKGROUND):
+                self.assertEqual(api.get_client('cli_1').id, 'cli_1')
+            self.assertEqual(api.get_client('cli_1').id, 'cli_1')
+            self.assertEqual(lanes, [{INTERACTIVE: 0, BACKGROUND: 1},
+                {INTERACTIVE: 1, BACKGROUND: 0}])
+            api.close()
+        finally:
+            server.stop()
+
+    def test_iter_pages(self):
+        def page(r):
+            offset = int(parse_qs(r.path.split('?')[1])['offset'][0])
+            return (200, json.dumps({'data_count': 5, 'data': [{
+                'id': 'tran_{0}'.format(x), 'created_at': 1400000000, 'updated_at': 1400000000
+            } for x in range(offset, min(offset + 2, 5))]}))
+
+        server = StubServer({'/v2/transactions/': page})
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, scheduler=True)
+            pages = list(api.iter_pages('transactions', count=2, order='created_at_asc'))
+            self.assertEqual([[x.id for x in p] for p in pages],
+                [['tran_0', 'tran_1'], ['tran_2', 'tran_3'], ['tran_4']])
+            self.assertEqual(parse_qs(server.requests[-1][1].split('?')[1]),
+                {'count': ['2'], 'offset': ['4'], 'order': ['created_at_asc']})
+            self.assertEqual(api.scheduler.running, {INTERACTIVE: 0, BACKGROUND: 0})
+        finally:
+            server.stop()
+
+    def test_resolve(self):
+        ts = {'created_at': 1400000000, 'updated_at': 1400000000}
+        server = StubServer({
+            '/v2/transactions/tran_1': (200, json.dumps({'data': dict(ts, id='tran_1',
+                client='cli_2')})),
+            '/v2/clients/cli_2': (200, json.dumps({'data': dict(ts, id='cli_2')})),
+        })
+        try:
+            api = Paymill('fake-key', base_url=server.base_url)
+            refunds = [Refund(id='ref_{0}'.format(x), transaction=x < 3 and 'tran_1' or 'tran_9',
+                **ts) for x in range(5)]
+            client = Client(id='cli_1', payment=['pay_1', dict(ts, id='pay_2', client='cli_1')],
+                **ts)
+            self.assertEqual(client.payment[0], 'pay_1')
+
+            resolve(api, refunds + [client], depth=2)
+            self.assertTrue(refunds[0].transaction is refunds[2].transaction)
+            self.assertEqual(refunds[0].transaction.client.id, 'cli_2')
+            self.assertEqual(refunds[4].transaction, 'tran_9')
+            self.assertTrue(client.payment[1].client is client)
+
+            # tran_1, tran_9, cli_2 and pay_1 fetched once each
+            self.assertEqual(len(server.requests), 4)
+        finally:
+            server.stop()
+
+    def test_identity_map(self):
+        def item(x, updated_at=1400000000):
+            return {
+                'id': 'tran_{0}'.format(x), 'currency': 'EUR', 'created_at': 1400000000,
+                'updated_at': 1400000000, 'client': {
+                    'id': 'cli_1', 'created_at': 1400000000, 'updated_at': updated_at,
+                },
+            }
+
+        data = json.loads(json.dumps({'data': [item(1), item(2), item(3, 1400000001)]}))
+        page = decode_data(data, Transaction)
+        self.assertTrue(page[0].client is not page[1].client)
+
+        page = decode_data(data, Transaction, identity_map=True)
+        self.assertTrue(page[0].client is page[1].client)
+        self.assertTrue(page[0].client is not page[2].client)
+        self.assertTrue(page[0].currency is page[1].currency)
+        self.assertTrue(page[0].created_at is page[2].client.created_at)
+
+        with IdentityMap() as identity_map:
+            first = decode_data(data, Transaction, identity_map=True)
+            second = decode_data(json.loads(json.dumps({'data': item(1)})), Transaction)
+        self.assertTrue(first[0] is second)
+        self.assertEqual(len(identity_map.objects), 5)
+
+        # Maps follow calls run on other threads for the current one
+        server = StubServer({'/v2/clients/cli_1': (200, json.dumps({'data': item(1)['client']}))})
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, hedge=True)
+            pool = PaymillPool(max_connections=2, base_url=server.base_url)
+            pool.register('shop1', 'key1')
+            pool.register('shop2', 'key2')
+            transaction = Transaction(**dict(item(1), client='cli_1'))
+            with IdentityMap():
+                client = api.get_client('cli_1')
+                self.assertTrue(api.get_client('cli_1') is client)
+                self.assertEqual([x is client for x in pool.fan_out('get_client', 'cli_1')
+                    .values()], [True, True])
+                resolve(api, [transaction])
+                self.assertTrue(transaction.client is client)
+            self.assertTrue(api.get_client('cli_1') is not client)
+            pool.close()
+            api.close()
+        finally:
+            server.stop()
+
+    def test_cassette(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'cassette.jsonl.gz')
+        server = StubServer({
+            '/v2/offers/offer_1': (200, b'{"data": {"id": "offer_1", "name": "caf\xc3\xa9",'
+                b' "created_at": 1400000000, "updated_at": 1400000000}}'),
+            '/v2/clients/': (200, b'"id";"email"\n"cli_1";"\xe9"\n', {'Content-Type': 'text/csv'}),
+        })
+        try:
+            cassette = Cassette(path)
+            api = Paymill('secret-key', base_url=server.base_url,
+                handlers=[RecordProcessor(cassette)])
+            self.assertEqual(api.get_offer('offer_1').name, 'café')
+            self.assertRaises(PaymillError, api.get_offer, 'offer_2')
+            csv = api.export_clients()
+            self.assertRaises(PaymillError, api.new_offer, 100, 'foo')
+            cassette.close()
+        finally:
+            server.stop()
+
+        try:
+            cassette = Cassette(path).load()
+            self.assertEqual(len(cassette.interactions), 4)
+            self.assertEqual(cassette.interactions[0]['headers']['Authorization'], '<redacted>')
+            self.assertFalse('secret-key' in repr(cassette.interactions))
+
+            api = Paymill('other-key', base_url='https://api.example.net/v2/',
+                handlers=[ReplayHandler(cassette, speed=1000)])
+            self.assertEqual(api.get_offer('offer_1').name, 'café')
+            self.assertRaises(PaymillError, api.get_offer, 'offer_2')
+            self.assertEqual(api.export_clients(), csv)
+            self.assertRaises(Exception, api.get_offer, 'offer_3')
+            self.assertRaises(PaymillError, api.new_offer, 100, 'bar')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_loadtest(self):
+        options = loadtest.get_parser().parse_args([
+            '--duration', '0.3', '--concurrency', '2', '--count', '100', '--error-rate', '0.2',
+        ])
+        report = loadtest.run(options)
+        self.assertTrue(report['requests'] > 0)
+        self.assertEqual(report['requests'],
+            sum(x['count'] for x in report['operations'].values()))
+        self.assertTrue(report['latency']['p50'] <= report['latency']['p99'])
+        self.assertTrue(report['cpu_seconds'] > 0)
+        self.assertTrue(loadtest.format_report(report).startswith('Requests: '))
+        self.assertRaises(ValueError, loadtest.parse_mix, 'foo=1')
+
+    def test_export(self):
+        server = loadtest.StandInServer(data_count=250).start()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, max_connections=2)
+            output = os.path.join(tmp_dir, 'transactions.ndjson')
+            checkpoint = os.path.join(tmp_dir, 'checkpoint')
+            exporter = Exporter(api, 'transactions', count=100, workers=2, checkpoint=checkpoint)
+
+            self.assertEqual(exporter.export(output, until=1400000000), 250)
+            with open(output) as fp:
+                ids = [json.loads(x)['id'] for x in fp]
+            self.assertEqual(ids, ['tran_{0}'.format(x) for x in range(250)])
+            with open(checkpoint) as fp:
+                self.assertEqual(json.load(fp)['offset'], 300)
+
+            # Resumed from the checkpoint with its end time: nothing left to export
+            self.assertEqual(exporter.export(output), 0)
+            self.assertRaises(ValueError, exporter.export, output, since=1)
+
+            # Rows written after the last saved checkpoint are not duplicated
+            with open(checkpoint) as fp:
+                state = json.load(fp)
+            with open(output) as fp:
+                state.update(offset=200, position=len(''.join(fp.readlines()[:200])))
+            with open(checkpoint, 'w') as fp:
+                json.dump(state, fp)
+            self.assertEqual(exporter.export(output), 50)
+            with open(output) as fp:
+                self.assertEqual([json.loads(x)['id'] for x in fp], ids)
+
+            output = os.path.join(tmp_dir, 'transactions.csv')
+            self.assertEqual(Exporter(api, 'transactions').export(output, 'csv'), 250)
+            with open(output) as fp:
+                lines = fp.read().splitlines()
+            self.assertEqual(len(lines), 251)
+            self.assertEqual(lines[0].split(',')[:3], ['id', 'amount', 'origin_amount'])
+            self.assertIn('pay_1,client_1', lines[2])
+            api.close()
+        finally:
+            server.stop()
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipUnless(HAS_NUMPY, 'requires numpy')
+    def test_projection(self):
+        def ts(*args):
+            return calendar.timegm(datetime(*args).timetuple())
+
+        self.assertEqual(parse_interval('2 WEEK'), (2, 'WEEK'))
+        self.assertEqual(parse_interval('year'), (1, 'YEAR'))
+        self.assertRaises(ValueError, parse_interval, '2 FORTNIGHT')
+
+        offers = {
+            'offer_m': {'id': 'offer_m', 'interval': '1 MONTH', 'amount': 1000},
+            'offer_y': {'id': 'offer_y', 'interval': '1 YEAR', 'amount': 9900},
+        }
+        subscriptions = SubscriptionArrays.from_subscriptions([
+            {'id': 'sub_1', 'offer': 'offer_m', 'next_capture_at': ts(2016, 1, 31, 10)},
+            {'id': 'sub_2', 'next_capture_at': ts(2016, 1, 1), 'offer': {
+                'id': 'offer_w', 'interval': '2 WEEK', 'amount': 500, 'currency': 'USD'}},
+            {'id': 'sub_3', 'offer': 'offer_y', 'next_capture_at': ts(2016, 2, 29)},
+            {'id': 'sub_4', 'offer': 'offer_m', 'next_capture_at': ts(2016, 1, 15),
+                'cancel_at_period_end': True},
+            {'id': 'sub_5', 'offer': 'offer_m', 'next_capture_at': ts(2016, 1, 15),
+                'canceled_at': ts(2016, 3, 1)},
+            {'id': 'sub_6', 'offer': 'offer_m', 'next_capture_at': None,
+                'created_at': 1400000000},
+            # Left out of the projection
+            {'id': 'sub_7', 'offer': [], 'next_capture_at': ts(2016, 1, 1)},
+            {'id': 'sub_8', 'offer': 'offer_x', 'next_capture_at': ts(2016, 1, 1)},
+            {'id': 'sub_9', 'next_capture_at': ts(2016, 1, 1), 'offer': {
+                'id': 'offer_d', 'interval': '2 DECADE', 'amount': 500}},
+        ], offers)
+        self.assertEqual(len(subscriptions), 6)
+        self.assertEqual(subscriptions.skipped, [('sub_7', 'No offer'),
+            ('sub_8', 'Unknown offer: offer_x'), ('sub_9', "Invalid interval: u'2 DECADE'")])
+        self.assertEqual(subscriptions.currencies, ['EUR', 'USD'])
+
+        projection = subscriptions.project(ts(2016, 2, 1), ts(2016, 4, 1))
+        schedule = [(t, x) for t, x, amount in projection.schedule() if x != 'sub_6']
+        self.assertEqual(schedule, [
+            (ts(2016, 2, 12), 'sub_2'), (ts(2016, 2, 15), 'sub_5'), (ts(2016, 2, 26), 'sub_2'),
+            (ts(2016, 2, 29), 'sub_3'), (ts(2016, 2, 29, 10), 'sub_1'),
+            (ts(2016, 3, 11), 'sub_2'), (ts(2016, 3, 25), 'sub_2'),
+            (ts(2016, 3, 31, 10), 'sub_1'),
+        ])
+
+        revenue = subscriptions.project(ts(2017, 2, 1), ts(2017, 3, 1)).revenue()
+        rows = [x for x in revenue.rows() if x[0] == date(2017, 2, 28)]
+        self.assertEqual(rows, [(date(2017, 2, 28), 'EUR', 'offer_m', 1, 1000),
+            (date(2017, 2, 28), 'EUR', 'offer_y', 1, 9900)])
+        self.assertEqual(sum(revenue.amount), 2 * 1000 + 2 * 500 + 9900)
+
+    def test_preauth_scheduler(self):
+        tran = (b'{"data": {"id": "tran_1", "amount": "1000", "created_at": 1400000000,'
+            + b' "updated_at": 1400000000}}')
+        preauth = (b'{"data": {"id": "preauth_2", "status": "deleted", "created_at": 1400000000,'
+            + b' "updated_at": 1400000000}}')
+        server = StubServer({
+            '/v2/transactions/': (200, tran),
+            '/v2/preauthorizations/preauth_2': (200, preauth),
+            '/v2/preauthorizations/preauth_3': (500, b'{"error": "Internal Server Error"}'),
+            '/v2/preauthorizations/preauth_4': (404, b'{"error": "Not Found"}'),
+        })
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            api = Paymill('fake-key', base_url=server.base_url)
+            path = os.path.join(tmp_dir, 'preauths.db')
+            now = time.time()
+
+            scheduler = PreauthScheduler(api, path, workers=2, batch_size=2)
+            scheduler.schedule('preauth_1', now - 10, amount=1000, currency='USD')
+            for x in range(2, 5):
+                scheduler.schedule('preauth_{0}'.format(x), now - x, RELEASE)
+            scheduler.schedule('preauth_5', now + 3600, amount=500)
+            self.assertRaises(ValueError, scheduler.schedule, 'preauth_6', now)
+            self.assertEqual(scheduler.track([[Preauthorization(
+                id='preauth_7', status='open', amount=100, created_at=1400000000,
+                updated_at=1400000000,
+            ), Preauthorization(
+                id='preauth_5', status='open', amount=100, created_at=1400000000,
+                updated_at=1400000000,
+            )]], 86400), 1)
+
+            self.assertEqual(scheduler.run_due(now), 5)
+            self.assertEqual(scheduler.get('preauth_1')['result'], 'tran_1')
+            self.assertEqual(sorted(x[:2] for x in server.requests)[-2:], [
+                ('POST', '/v2/transactions/'), ('POST', '/v2/transactions/'),
+            ])
+            self.assertEqual(scheduler.get('preauth_2')['state'], 'done')
+            self.assertEqual(scheduler.get('preauth_4')['state'], 'failed')
+            self.assertEqual(scheduler.get('preauth_4')['result'], '404 Not Found')
+
+            # Server errors are retried later
+            retried = scheduler.get('preauth_3')
+            self.assertEqual((retried['state'], retried['attempts']), ('pending', 1))
+            self.assertTrue(retried['due'] > now)
+            self.assertEqual(scheduler.get('preauth_7')['state'], 'done')
+            scheduler.close()
+
+            scheduler = PreauthScheduler(api, path)
+            self.assertEqual(scheduler.pending(), 2)
+            self.assertEqual(scheduler.next_due(), retried['due'])
+            scheduler.cancel('preauth_5')
+            self.assertEqual(scheduler.get('preauth_5'), None)
+            scheduler.close()
+            api.close()
+        finally:
+            server.stop()
+            shutil.rmtree(tmp_dir)
+
+    def test_stream(self):
+        body = (b'{"data_count": 12345, "data": [{"id": "client_1",'
+            + b' "description": "\xc3\xa9t\xc3\xa9", "amount": 1234567},'
+            + b' {"id": "client_2", "tags": [1, {"a": null}]} ], "mode": "test"}')
+        for size in (1, 3, 7, 8192):
+            self.assertEqual(list(iter_envelope(StringIO(body), size)), [
+                ('data_count', 12345),
+                (ITEM, {'id': 'client_1', 'description': '\xe9t\xe9', 'amount': 1234567}),
+                (ITEM, {'id': 'client_2', 'tags': [1, {'a': None}]}),
+                ('mode', 'test'),
+            ])
+        self.assertRaises(ValueError, list, iter_envelope(StringIO(body[:-20]), 7))
+        self.assertEqual(list(iter_envelope(StringIO(b'{"data": []}'))), [])
+
+        transactions = json.dumps({'data': [{
+            'id': 'tran_{0}'.format(x), 'created_at': 1400000000, 'updated_at': 1400000000,
+            'client': {'id': 'client_1', 'created_at': 1400000000, 'updated_at': 1400000000},
+        } for x in range(200)], 'data_count': 200}).encode('utf-8')
+        server = StubServer({'/v2/transactions/': (200, transactions)})
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, max_connections=1)
+            items = stream(api, 'transactions', chunk_size=1024, count=200)
+            self.assertEqual(items.data_count, None)
+            result = list(items)
+            self.assertEqual([x.id for x in result], ['tran_{0}'.format(x) for x in range(200)])
+            self.assertTrue(isinstance(result[0].client, Client))
+            self.assertEqual(items.data_count, 200)
+
+            # Stopped early: the connection is not reused
+            with stream(api, 'transactions', chunk_size=1024) as items:
+                self.assertEqual(next(iter(items)).id, 'tran_0')
+            self.assertEqual(len(api.get_transactions()), 200)
+            self.assertEqual(api.metrics['calls'], 3)
+            self.assertEqual(server.connections, 2)
+            api.close()
+        finally:
+            server.stop()
+
+    def test_outbox(self):
+        client = (b'{"data": {"id": "client_1", "created_at": 1400000000,'
+            + b' "updated_at": 1400000000}}')
+        server = StubServer({
+            '/v2/clients/client_1': (200, client),
+            '/v2/offers/offer_1': (503, b'{"error": "Service Unavailable"}'),
+            '/v2/webhooks/hook_1': (404, b'{"error": "Not Found"}'),
+        })
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            api = Paymill('fake-key', base_url=server.base_url)
+            path = os.path.join(tmp_dir, 'outbox.db')
+
+            outbox = Outbox(api, path, retry_delay=60)
+            outbox.update_client('client_1', email='a@example.com')
+            outbox.update_client('client_1', None, 'VIP')
+            outbox.update_client(Client(id='client_1', created_at=1400000000,
+                updated_at=1400000000), email='b@example.com')
+            outbox.update_offer('offer_1', 'Gold')
+            # Webhooks take a URL or an email, the later one replaces the other
+            outbox.update_webhook('hook_1', url='http://example.com/old')
+            outbox.update_webhook('hook_1', email='hooks@example.com')
+            outbox.update_webhook('hook_1', url='http://example.com/hook')
+            self.assertRaises(ValueError, outbox.enqueue, 'delete_client', 'client_1')
+            self.assertEqual(outbox.pending(), 3)
+            outbox.close()
+
+            # Updates survive restarts
+            outbox = Outbox(api, path, retry_delay=60)
+            self.assertEqual(outbox.dispatch(), 3)
+            puts = [x for x in server.requests if x[1] == '/v2/clients/client_1']
+            self.assertEqual(len(puts), 1)
+            self.assertEqual(parse_qs(puts[0][3]),
+                {'email': ['b@example.com'], 'description': ['VIP']})
+
+            # Server errors are retried later, merged with newer updates
+            outbox.update_offer('offer_1', 'Platinum')
+            self.assertEqual(outbox.dispatch(), 0)
+            self.assertEqual(outbox.pending(), 1)
+            server.routes['/v2/offers/offer_1'] = (200, client.replace(b'client_1', b'offer_1'))
+            self.assertEqual(outbox.dispatch(time.time() + 3600), 1)
+            self.assertEqual(parse_qs(server.requests[-1][3]), {'name': ['Platinum']})
+            self.assertEqual(outbox.failed(), [
+                ('update_webhook', 'hook_1', {'url': 'http://example.com/hook'}, '404 Not Found'),
+            ])
+            outbox.close()
+
+            # Background dispatcher
+            outbox = Outbox(api, path, max_attempts=1).start()
+            outbox.update_client('client_1', description='Regular')
+            self.assertTrue(outbox.flush(5))
+            self.assertEqual(parse_qs(server.requests[-1][3]), {'description': ['Regular']})
+            outbox.close()
+            api.close()
+        finally:
+            server.stop()
+            shutil.rmtree(tmp_dir)
+
+    def test_save(self):
+        client = (b'{"data": {"id": "client_1", "email": "b@example.com", "description": "VIP",'
+            + b' "created_at": 1400000000, "updated_at": 1500000000}}')
+        server = StubServer({'/v2/clients/client_1': (200, client)})
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            api = Paymill('fake-key', base_url=server.base_url)
+            obj = Client(id='client_1', email='a@example.com', description='VIP',
+                created_at=1400000000, updated_at=1400000000)
+            self.assertFalse(obj.save(api))
+
+            obj.description = 'Regular'
+            obj.description = 'VIP'
+            obj.payment = []
+            self.assertEqual(obj.changed(), {})
+            self.assertFalse(obj.save(api))
+            self.assertEqual(server.requests, [])
+
+            obj.email = 'b@example.com'
+            self.assertEqual(obj.changed(), {'email': 'b@example.com'})
+            self.assertTrue(obj.save(api))
+            self.assertEqual(parse_qs(server.requests[0][3]), {'email': ['b@example.com']})
+            self.assertEqual(obj.updated_at, datetime.fromtimestamp(1500000000))
+            self.assertEqual(obj.changed(), {})
+            self.assertFalse(obj.save(api))
+            self.assertEqual(len(server.requests), 1)
+
+            # Nothing is sent for fields set to None, the change is kept
+            obj.description = None
+            self.assertFalse(obj.save(api))
+            self.assertEqual(obj.changed(), {'description': None})
+
+            subscription = decode_data({'data': {'id': 'sub_1', 'offer': [],
+                'created_at': 1400000000, 'updated_at': 1400000000}}, Subscription)
+            self.assertEqual(subscription.offer, None)
+            self.assertFalse(subscription.save(api))
+            self.assertEqual(len(server.requests), 1)
+
+            # Through an outbox
+            server.routes['/v2/subscriptions/sub_1'] = (200, b'{"data": {"id": "sub_1",'
+                b' "offer": {"id": "offer_2", "created_at": 1400000000,'
+                b' "updated_at": 1400000000}, "created_at": 1400000000,'
+                b' "updated_at": 1500000000}}')
+            outbox = Outbox(api, os.path.join(tmp_dir, 'outbox.db'))
+            subscription.offer = Offer(id='offer_2', created_at=1400000000,
+                updated_at=1400000000)
+            self.assertTrue(subscription.save(outbox))
+            self.assertEqual(subscription.changed(), {})
+            self.assertEqual(outbox.dispatch(), 1)
+            self.assertEqual(server.requests[-1][:2], ('PUT', '/v2/subscriptions/sub_1'))
+            self.assertEqual(parse_qs(server.requests[-1][3]), {'offer': ['offer_2']})
+            outbox.close()
+            api.close()
+        finally:
+            server.stop()
+            shutil.rmtree(tmp_dir)
+
+    def test_workflow(self):
+        def slow(body):
+            def route(handler):
+                time.sleep(0.2)
+                return (200, body)
+            return route
+
+        def obj(object_id):
+            return ('{{"data": {{"id": "{0}", "created_at": 1400000000,'
+                ' "updated_at": 1400000000}}}}').format(object_id).encode('utf-8')
+
+        server = StubServer({
+            '/v2/clients/': slow(obj('client_1')),
+            '/v2/offers/offer_1': slow(obj('offer_1')),
+            '/v2/payments/': (200, obj('pay_1')),
+            '/v2/subscriptions/': (200, obj('sub_1')),
+            '/v2/clients/client_1': (200, obj('client_1')),
+            '/v2/payments/pay_1': (200, obj('pay_1')),
+        })
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, max_connections=4)
+
+            def signup():
+                workflow = Workflow(api)
+                client = workflow.step('client', 'new_client', 'a@example.com',
+                    compensate='delete_client')
+                offer = workflow.step('offer', 'get_offer', 'offer_1')
+                card = workflow.step('card', 'new_card', 'tok_1', client=client.id,
+                    compensate='delete_card')
+                workflow.step('subscription', 'new_subscription', client, offer, card)
+                self.assertRaises(ValueError, workflow.step, 'card', 'get_card', 'pay_1')
+                return workflow
+
+            start = time.time()
+            results = signup().run()
+            self.assertTrue(time.time() - start < 0.35)
+            self.assertEqual(list(results), ['client', 'offer', 'card', 'subscription'])
+            self.assertEqual(results['subscription'].id, 'sub_1')
+            card = [x for x in server.requests if x[1] == '/v2/payments/'][0]
+            self.assertEqual(parse_qs(card[3]), {'token': ['tok_1'], 'client': ['client_1']})
+
+            del server.requests[:]
+            server.routes['/v2/subscriptions/'] = (403, b'{"data": {"response_code": 50102}}')
+            with self.assertRaises(WorkflowError) as cm:
+                signup().run()
+            self.assertEqual((cm.exception.step, cm.exception.error.code), ('subscription', 50102))
+            self.assertEqual(sorted(cm.exception.results), ['card', 'client', 'offer'])
+            self.assertEqual([x[:2] for x in server.requests if x[0] == 'DELETE'], [
+                ('DELETE', '/v2/payments/pay_1'), ('DELETE', '/v2/clients/client_1'),
+            ])
+            api.close()
+        finally:
+            server.stop()
+
+    def test_query(self):
+        def page(handler):
+            query = dict((k, v[0]) for k, v in parse_qs(handler.path.split('?')[1]).items())
+            offset, count = int(query.get('offset', 0)), int(query['count'])
+            return (200, json.dumps({'data_count': 1000, 'data': [{
+                'id': 'tran_{0}'.format(x), 'amount': str(x % 7 * 100), 'currency': 'EUR',
+                'description': x % 10 and 'order' or 'gift card', 'status': 'closed',
+                'client': x % 2 and 'client_1' or None,
+                'created_at': 1400000000 - x, 'updated_at': 1400000000,
+            } for x in range(offset, min(1000, offset + count))]}).encode('utf-8'))
+
+        server = StubServer({'/v2/transactions/': page})
+        try:
+            api = Paymill('fake-key', base_url=server.base_url)
+
+            def params(request):
+                return dict((k, v[0]) for k, v in parse_qs(request[1].split('?')[1]).items())
+
+            query = api.transactions.filter(status='closed', description__contains='gift',
+                created_at__range=(date(2014, 1, 1), 1400000000)).order_by('-created_at')
+            result = list(query.limit(15))
+            self.assertEqual([x.id for x in result][:3], ['tran_0', 'tran_10', 'tran_20'])
+            self.assertEqual(len(result), 15)
+            self.assertEqual(len(server.requests), 2)
+            pushed = params(server.requests[0])
+            self.assertEqual((pushed['status'], pushed['order'], pushed['count']),
+                ('closed', 'created_at_desc', '100'))
+            self.assertEqual(pushed['created_at'], '{0}-1400000000'.format(
+                int(time.mktime(date(2014, 1, 1).timetuple()))))
+            self.assertNotIn('description', pushed)
+
+            # Without client-side filters, only the needed objects are requested
+            del server.requests[:]
+            self.assertEqual(api.transactions.filter(amount__gt=300).first().id, 'tran_0')
+            self.assertEqual((params(server.requests[0])['count'],
+                params(server.requests[0])['amount']), ('1', '>300'))
+            client = Client(id='client_1', created_at=1400000000, updated_at=1400000000)
+            self.assertEqual(api.transactions.filter(client=client).count(), 1000)
+            self.assertEqual(params(server.requests[-1])['client'], 'client_1')
+
+            # Values left out of requests are matched locally, counts stop at the limit
+            result = list(api.transactions.filter(client=None).limit(3))
+            self.assertEqual([x.id for x in result], ['tran_0', 'tran_2', 'tran_4'])
+            self.assertNotIn('client', params(server.requests[-1]))
+            del server.requests[:]
+            self.assertEqual(api.transactions.filter(status__in=('closed',)).limit(2).count(), 2)
+            self.assertEqual(len(server.requests), 1)
+
+            # Sorting the API does not support is done locally
+            result = list(api.transactions.filter(created_at__gte=1400000000 - 20)
+                .order_by('-amount', 'created_at').limit(3))
+            self.assertEqual([x.id for x in result], ['tran_20', 'tran_13', 'tran_6'])
+            result = list(api.transactions.filter(amount__in=('0', '600')).limit(3))
+            self.assertEqual([x.id for x in result], ['tran_0', 'tran_6', 'tran_7'])
+            self.assertRaises(ValueError, api.transactions.filter, amount__like='1')
+            api.close()
+        finally:
+            server.stop()
+
+    def test_window_scan(self):
+        # Busy hours hold most of the objects
+        created = sorted([1400000000 + x * 60 for x in range(500)]
+            + [1400100000 + x for x in range(1500)])
+        data = [{'id': 'tran_{0}'.format(i), 'created_at': t, 'updated_at': t}
+            for i, t in enumerate(created)]
+
+        def page(handler):
+            query = dict((k, v[0]) for k, v in parse_qs(handler.path.split('?')[1]).items())
+            start, end = [int(x) for x in query['created_at'].split('-')]
+            offset, count = int(query['offset']), int(query['count'])
+            matches = [x for x in data if start <= x['created_at'] <= end]
+            # Objects created meanwhile do not move the offsets of past windows
+            data.append({'id': 'tran_new_{0}'.format(len(data)), 'created_at': 1500000000,
+                'updated_at': 1500000000})
+            return (200, json.dumps({'data_count': len(matches),
+                'data': matches[offset:offset + count]}).encode('utf-8'))
+
+        server = StubServer({'/v2/transactions/': page})
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, max_connections=4)
+            scan = WindowScan(api, 'transactions', workers=4, target=300)
+            ids = [x.id for x in scan.scan(1400000000, 1400200000)]
+            self.assertEqual(ids, ['tran_{0}'.format(x) for x in range(2000)])
+            self.assertTrue(scan.windows >= 7)
+            self.assertEqual(scan.requests, len(server.requests))
+            self.assertEqual(scan.duplicates, 0)
+            api.close()
+        finally:
+            server.stop()
+
+    def test_snapshot_diff(self):
+        def snapshot(changes):
+            clients = []
+            for i in range(1200):
+                data = {'id': 'client_{0}'.format(i), 'email': 'c{0}@example.com'.format(i),
+                    'created_at': 1400000000 + i, 'updated_at': 1400000000 + i}
+                data.update(changes.get(i, {}))
+                clients.append(Client(**data))
+            return clients
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            index = SnapshotIndex(os.path.join(tmp_dir, 'clients.db'))
+            changes = list(index.diff(snapshot({})))
+            self.assertEqual(len(changes), 1200)
+            self.assertEqual(changes[0].kind, ADDED)
+            self.assertEqual(changes[0].fields['email'], (None, 'c0@example.com'))
+            self.assertEqual(list(index.diff(snapshot({}))), [])
+
+            # Pages or objects, the last 600 clients are deleted
+            pages = [PaymillList(600, snapshot({
+                5: {'email': 'new@example.com', 'updated_at': 1500000000},
+            })[:600]), Client(id='client_new', created_at=1500000000, updated_at=1500000000)]
+            changes = sorted(index.diff(pages, update=False))
+            self.assertEqual([(x.kind, x.id) for x in changes[:2]],
+                [(ADDED, 'client_new'), (CHANGED, 'client_5')])
+            self.assertEqual(changes[1].fields, {
+                'email': ('c5@example.com', 'new@example.com'),
+                'updated_at': (1400000005, 1500000000),
+            })
+            self.assertEqual(set(x.kind for x in changes[2:]), set([REMOVED]))
+            self.assertEqual(len(changes), 2 + 600)
+            self.assertEqual(len(index), 1200)
+
+            self.assertEqual(len(list(index.diff(pages))), 602)
+            self.assertEqual(len(index), 601)
+            index.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_settlement_aggregates(self):
+        day = calendar.timegm((2014, 5, 13, 12, 0, 0))
+
+        def transaction(i, status='closed', updated_at=day, **kwargs):
+            data = {'id': 'tran_{0}'.format(i), 'origin_amount': 1000, 'currency': 'EUR',
+                'status': status, 'livemode': True, 'created_at': day + i,
+                'updated_at': updated_at, 'fees': [{'type': 'application', 'amount': 30}]}
+            data.update(kwargs)
+            return data
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            aggregates = SettlementAggregates(os.path.join(tmp_dir, 'totals.db'))
+            page = PaymillList(3, [Transaction(**transaction(x)) for x in range(2)] + [
+                Transaction(**transaction(2, 'partial_refunded', refunds=[{
+                    'id': 'refund_1', 'amount': 400, 'status': 'refunded', 'livemode': True,
+                    'transaction': 'tran_2', 'created_at': day + 3600,
+                    'updated_at': day + 3600}]))
+            ])
+            self.assertEqual(aggregates.feed([page]), 4)
+            self.assertEqual(aggregates.feed([page]), 0)
+            self.assertEqual(aggregates.get(date(2014, 5, 13), 'EUR', 'closed'),
+                Totals(2, 2000, 60, 0, 0, 0))
+            self.assertEqual(aggregates.get('2014-05-13', 'EUR', 'refunded'),
+                Totals(0, 0, 0, 0, 1, 400))
+
+            # A changed transaction moves to its new key, older versions are ignored
+            event = {'event': {'event_type': 'chargeback.executed',
+                'event_resource': transaction(1, 'chargeback', day + 7200)}}
+            self.assertEqual(aggregates.feed_webhook(json.dumps(event)), 1)
+            self.assertEqual(aggregates.feed([Transaction(**transaction(1))]), 0)
+            self.assertEqual(aggregates.get('2014-05-13', 'EUR', 'closed'),
+                Totals(1, 1000, 30, 0, 0, 0))
+            self.assertEqual([x[2:] for x in aggregates.rows(date(2014, 5, 1), currency='EUR')], [
+                ('chargeback', True, Totals(1, 1000, 30, 1, 0, 0)),
+                ('closed', True, Totals(1, 1000, 30, 0, 0, 0)),
+                ('partial_refunded', True, Totals(1, 1000, 30, 0, 0, 0)),
+                ('refunded', True, Totals(0, 0, 0, 0, 1, 400)),
+            ])
+            self.assertEqual(aggregates.rows(end='2014-05-12'), [])
+            aggregates.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_settlement_aggregates_refund_order(self):
+        day = calendar.timegm((2014, 5, 13, 12, 0, 0))
+        tran = {'id': 'tran_1', 'origin_amount': 1000, 'currency': 'EUR', 'status': 'closed',
+            'livemode': True, 'created_at': day, 'updated_at': day}
+        refund = {'id': 'refund_1', 'amount': 400, 'status': 'refunded', 'livemode': True,
+            'transaction': 'tran_1', 'created_at': day + 3600, 'updated_at': day + 3600}
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            rows = []
+            # A refund fed before its transaction moves to its currency once it is fed
+            orders = [(Transaction(**tran), Refund(**refund)),
+                (Refund(**refund), Transaction(**tran))]
+            for i, objects in enumerate(orders):
+                aggregates = SettlementAggregates(os.path.join(tmp_dir, '{0}.db'.format(i)))
+                for obj in objects:
+                    self.assertEqual(aggregates.feed([obj]), 1)
+                rows.append(aggregates.rows())
+                aggregates.close()
+            self.assertEqual(rows[0], rows[1])
+            self.assertEqual([x[1:] for x in rows[1]], [
+                ('EUR', 'closed', True, Totals(1, 1000, 0, 0, 0, 0)),
+                ('EUR', 'refunded', True, Totals(0, 0, 0, 0, 1, 400)),
+            ])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_tracing(self):
+        data = [{'id': 'tran_{0}'.format(x), 'created_at': 1400000000, 'updated_at': 1400000000}
+            for x in range(5)]
+
+        def page(handler):
+            query = dict((k, v[0]) for k, v in parse_qs(handler.path.split('?')[1]).items())
+            offset = int(query['offset'])
+            return (200, json.dumps({'data_count': len(data),
+                'data': data[offset:offset + int(query['count'])]}).encode('utf-8'))
+
+        server = StubServer({'/v2/transactions/': page})
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'spans.json')
+            exporter = FileExporter(path)
+            api = Paymill('fake-key', base_url=server.base_url, tracer=Tracer(exporter))
+
+            # Continues the trace of the calling service
+            upstream = '00-{0}-{1}-01'.format('a' * 32, 'b' * 16)
+            with api.tracer.span('checkout', traceparent=upstream) as checkout:
+                self.assertEqual(len(list(api.iter_pages('transactions', count=2))), 3)
+                self.assertRaises(PaymillError, api.get_transaction, 'tran_x')
+            exporter.close()
+
+            with open(path) as f:
+                spans = [json.loads(x) for x in f]
+            by_id = dict((x['spanId'], x) for x in spans)
+            self.assertEqual(set(x['traceId'] for x in spans), set(['a' * 32]))
+            self.assertEqual(by_id[checkout.span_id]['parentSpanId'], 'b' * 16)
+
+            def children(span):
+                return [x for x in spans if x['parentSpanId'] == span['spanId']]
+
+            pages, = [x for x in spans if x['name'] == 'pmill.iter_pages']
+            self.assertEqual(pages['parentSpanId'], checkout.span_id)
+            requests = children(pages)
+            self.assertEqual([x['name'] for x in requests], ['pmill.request'] * 3)
+            self.assertEqual([x['name'] for x in children(requests[0])],
+                ['pmill.prepare', 'pmill.http', 'pmill.decode', 'pmill.build'])
+            self.assertEqual(requests[0]['attributes'], {'paymill.endpoint': 'transactions/',
+                'http.method': 'GET', 'http.status_code': 200})
+
+            failed, = [x for x in children(by_id[checkout.span_id])
+                if x['name'] == 'pmill.request']
+            self.assertEqual((failed['status']['code'], failed['attributes']['paymill.error_code'],
+                failed['attributes']['error.type']), ('ERROR', 404, 'PaymillError'))
+            http = [x for x in children(failed) if x['name'] == 'pmill.http'][0]
+            self.assertEqual(http['attributes']['http.status_code'], 404)
+
+            # Requests carry the span of their HTTP exchange
+            self.assertEqual(server.requests[-1][2]['traceparent'],
+                '00-{0}-{1}-01'.format('a' * 32, http['spanId']))
+            api.close()
+        finally:
+            server.stop()
+            shutil.rmtree(tmp_dir)
+
+    def test_profiler(self):
+        subscriptions = json.dumps({'data_count': 2000, 'data': [
+            {'id': 'sub_{0}'.format(x), 'offer': {'id': 'offer_1', 'created_at': 1400000000,
+                'updated_at': 1400000000}, 'created_at': 1400000000, 'updated_at': 1400000000}
+            for x in range(20)]}).encode('utf-8')
+
+        def slow(handler):
+            time.sleep(0.6)
+            return (200, '{"data": {"id": "client_1", "created_at": 1400000000,'
+                + ' "updated_at": 1400000000}}')
+
+        server = StubServer({'/v2/subscriptions/': (200, subscriptions), '/v2/clients/': slow})
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmp_dir, 'slow.log')
+            profiler = Profiler(sample_rate=1, interval=0.001, slow_threshold=0.3,
+                log_path=log_path)
+            api = Paymill('fake-key', base_url=server.base_url, profiler=profiler)
+            self.assertEqual(len(api.get_subscriptions()), 20)
+            api.new_client(email='secret@example.com', description='VIP')
+            profiler.close()
+            self.assertTrue(profiler._thread is None)
+
+            self.assertEqual((profiler.calls, profiler.sampled, profiler.slow), (2, 2, 1))
+            self.assertEqual(set(profiler.breakdown), set(['build', 'network', 'decode',
+                'construct', 'total', 'cpu', 'rss_kb']))
+            self.assertTrue(profiler.breakdown['network'] >= 0.6)
+            self.assertTrue(profiler.breakdown['construct'] > 0)
+
+            # Collapsed stacks start at the profiled call
+            lines = profiler.collapsed()
+            self.assertTrue(lines)
+            for line in lines:
+                self.assertTrue(re.match(r'^pmill\.profiling:call;\S+ \d+$', line), line)
+
+            with open(log_path) as f:
+                entry, = [json.loads(x) for x in f]
+            self.assertEqual((entry['method'], entry['endpoint']), ('POST', 'clients/'))
+            self.assertEqual(entry['params'], {'email': '***', 'description': '***'})
+            self.assertTrue(entry['duration'] >= 0.6)
+            self.assertTrue(entry['stages']['network'] >= 0.6)
+
+            # Sampling starts again after close()
+            profiler.reset()
+            api.new_client(email='secret@example.com')
+            self.assertTrue(profiler.collapsed())
+            profiler.close()
+            api.close()
+        finally:
+            server.stop()
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipIf(HAS_HTTP2, 'hyper is installed')
+    def test_http2_fallback(self):
+        server = StubServer({
+            '/v2/offers/offer_1': (200, '{"data": {"id": "offer_1", "created_at": 1400000000,'
+                + ' "updated_at": 1400000000}}'),
+        })
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, http2=True)
+            self.assertTrue(api.http2 is None)
+            self.assertEqual(api.get_offer('offer_1').id, 'offer_1')
+        finally:
+            server.stop()
+
+    def test_http2_request_fallback(self):
+        class Connection(object):
+            """Cleartext HTTP/2 connection failing with the errors given"""
+            instances = []
+            errors = {}
+
+            def __init__(self, host, secure, ssl_context):
+                self.instances.append(self)
+                self.closed = False
+
+            def connect(self):
+                if 'connect' in self.errors:
+                    raise self.errors['connect']
+
+            def request(self, *args, **kwargs):
+                raise self.errors['request']
+
+            def close(self):
+                self.closed = True
+
+        server = StubServer({
+            '/v2/offers/offer_1': (200, '{"data": {"id": "offer_1", "created_at": 1400000000,'
+                + ' "updated_at": 1400000000}}'),
+        })
+        key = (server.base_url.split('/')[2], False)
+        patched = {'HAS_HTTP2': True, 'HTTP20Connection': Connection,
+            'HTTP2ConnectionError': type(b'HTTP2ConnectionError', (Exception,), {})}
+        saved = dict((k, getattr(http2, k)) for k in patched)
+        try:
+            for k, v in patched.items():
+                setattr(http2, k, v)
+
+            # An HTTP/1.1 server fails the first exchange: requests go to HTTP/1.1 for good
+            Connection.errors = {'request': ValueError('Invalid frame')}
+            handler = http2.HTTP2Handler()
+            api = Paymill('fake-key', base_url=server.base_url, handlers=[handler])
+            self.assertEqual(api.get_offer('offer_1').id, 'offer_1')
+            self.assertEqual(api.get_offer('offer_1').id, 'offer_1')
+
+            self.assertEqual(len(Connection.instances), 1)
+            self.assertTrue(Connection.instances[0].closed)
+            self.assertEqual(handler._connections, {})
+            self.assertEqual(handler._fallback, {key: None})
+            self.assertEqual(len(server.requests), 2)
+
+            # Network errors only leave the host to HTTP/1.1 for a while
+            Connection.errors = {'connect': socket.timeout('timed out')}
+            handler = http2.HTTP2Handler(retry_after=60)
+            api = Paymill('fake-key', base_url=server.base_url, handlers=[handler])
+            self.assertEqual(api.get_offer('offer_1').id, 'offer_1')
+            self.assertEqual(api.get_offer('offer_1').id, 'offer_1')
+            self.assertEqual(len(Connection.instances), 2)
+            self.assertTrue(handler._fallback[key] > time.time() + 50)
+
+            handler._fallback[key] = time.time()
+            self.assertEqual(api.get_offer('offer_1').id, 'offer_1')
+            self.assertEqual(len(Connection.instances), 3)
+            self.assertEqual(len(server.requests), 5)
+        finally:
+            for k, v in saved.items():
+                setattr(http2, k, v)
+            server.stop()
+
+    @unittest.skipUnless(HAS_HTTP2 and h2, 'requires hyper and h2')
+    def test_http2(self):
+        server = H2StubServer({
+            b'/v2/offers/offer_1': (200, b'{"data": {"id": "offer_1", "created_at": 1400000000,'
+                + b' "updated_at": 1400000000}}'),
+        })
+        try:
+            api = Paymill('fake-key', base_url=server.base_url, http2=True)
+            threads = [threading.Thread(target=api.get_offer, args=('offer_1',))
+                for x in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(api.get_offer('offer_1').id, 'offer_1')
+            self.assertEqual(api.metrics['errors'], 0)
+            self.assertEqual(server.connections, 1)
+            api.close()
+        finally:
+            server.stop()
+
 
 class LiveTestCase(unittest.TestCase):
     def setUp(self):